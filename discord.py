@@ -9,8 +9,9 @@ import requests
 import traceback
 import websockets
 import srl_approve
+import nnlite
 
-from markov import MarkovChain
+from markov import open_chain, open_service, rejoin_chain, seed_remover
 from aiohttp import ClientSession
 from concurrent.futures import ThreadPoolExecutor
 
@@ -100,7 +101,7 @@ class DiscordBot:
         
         self._default_handlers()
         
-        self.mc = MarkovChain()
+        self.mc = open_chain()
         
         self.nn_temp = 0.7
         
@@ -160,6 +161,13 @@ class DiscordBot:
         self.__dict__.update(state)
         self._default_handlers()
         self.hb_task = None
+        self.mc = rejoin_chain(self.mc)
+        
+    def _nn_service(self):
+        if not 'nn' in self.__dict__ or self.nn is None:
+            self.nn = nnlite.NeuralService()
+        self.nn.start()
+        return self.nn
         
     async def _work_on(self,func,*args):
         return await asyncio.get_event_loop().run_in_executor(self.workers,func,*args)
@@ -199,6 +207,8 @@ class DiscordBot:
         if loop is None:
             loop = asyncio.get_event_loop()
         self.workers = ThreadPoolExecutor(max_workers=4)
+        if nnlite.model_available():
+            self._nn_service()
         self.reconnect = True
         while self.reconnect:
             try:
@@ -397,30 +407,18 @@ class DiscordBot:
         await self.send_message(channel_id,'Neural network temperature set to %0.02f'%self.nn_temp)
     
     async def cmd_nn(self,guild,channel_id,author_id,args):
-        if not 'nn' in self.__dict__ or self.nn is None:
-            try:
-                def _load_nn():                
-                    import nntextgen
-                    self.nn = nntextgen.LanguageCenter(model='nn.h5')
-                await self._work_on(_load_nn)
-            except:
-                print('can\'t load nntextgen module')
-                self.nn = None
-                raise 
         if not 'nn_temp' in self.__dict__:
             self.nn_temp = 0.7
-        if self.nn:
-            def _generate():
-                return self.nn.generate(args if args else '',temp=self.nn_temp,maxlen=250)
-            text = await self._work_on(_generate)
-            await self.send_message(channel_id,text)
+        text = await self._nn_service().generate(args if args else '',temp=self.nn_temp,maxlen=250)
+        await self.send_message(channel_id,text)
             
     async def hook_markov(self,guild,channel_id,author_id,text):
         text = re.sub(r'^\*\*<.+>\*\* *','',text) #strip ircbot nick prefix
-        await self._work_on(self.mc.process,text)
+        service = open_service(self.mc)
+        await service.learn(text)
         if self.ident[2].upper() in text.upper():
-            seed_text = re.sub(self.ident[2]+'[;,: ]*|[<>\\/\|\?.,\(\)!@#\$\%^&\*]','',text,flags=re.IGNORECASE)
+            seed_text = seed_remover(self.ident[2]).sub('',text)
             ' '.join(set(seed_text.split()))
-            reply = await self._work_on(self.mc.gen_reply,seed_text)
+            reply = await service.reply(seed_text)
             if reply:
                 await self.send_message(channel_id,reply)
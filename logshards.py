@@ -0,0 +1,22 @@
+import os
+import re
+
+def log_shards(paths,shard_size):
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0,max(size,1),shard_size):
+            yield path,start,min(start+shard_size,size)
+
+def shard_lines(path,start,end,strip=None):
+    # a shard owns every line that starts inside [start,end], the partial line at start belongs to the previous shard
+    strip = re.compile(strip) if strip else None
+    with open(path,'rb') as f:
+        f.seek(start)
+        if start > 0:
+            f.readline()
+        while f.tell() <= end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            text = line.decode('utf-8',errors='ignore').rstrip('\r\n')
+            yield strip.sub('',text) if strip else text
@@ -1,191 +1,1056 @@
 import apsw
 import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+import asyncio
+import multiprocessing
 import re
 import string
 import nltk
 import time
+import atexit
 import random
+import traceback
+import bisect
+import weakref
+import argparse
+import threading
+import itertools
+import functools
 import numpy as np
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from nltk.tokenize import TweetTokenizer
+from logshards import log_shards, shard_lines
 #from nltk.tokenize.moses import MosesTokenizer
 #from nltk.tokenize.moses import MosesDetokenizer
 
 nick_remover = re.compile('<.+>[ ,:]*')
 
-if hasattr(random,'choices'):
-    choices = random.choices
-else:
-    def choices(seq,weights=None,k=1):
-        if weights is None:
-            return [random.choice(seq) for i in range(k)]
-        else:
-            weights = np.asarray(weights)
-            cdf = np.cumsum(weights)
-            np.insert(cdf,0,0)
-            rnd = np.random.randint(cdf[-1],size=k)
-            idx = np.digitize(rnd,cdf)
-            return list(np.asarray(seq)[idx])
-
-def drop_index(c,depth):
-    c.execute('DROP INDEX ngram_%i;'%(depth,))
+@functools.lru_cache(maxsize=32)
+def seed_remover(nick):
+    return re.compile(re.escape(nick)+'[;,: ]*|[<>\\/\|\?.,\(\)!@#\$\%^&\*]',re.I)
 
-def create_index(c,depth,level=None):
-    names = string.ascii_lowercase[:level if level else min(depth+1,4)]
-    c.execute('CREATE UNIQUE INDEX ngram_%i ON ngrams_%i(%s);'%(depth,depth,','.join(names)))    
+class Successors:
+    __slots__ = ('tokens','cum_weights','index','extra')
+    
+    def __init__(self,tokens,cum_weights,index=None,extra=None):
+        self.tokens = tokens
+        self.cum_weights = cum_weights
+        self.index = index if index is not None else {token:i for i,token in enumerate(tokens)}
+        self.extra = extra
+        
+    def with_extra(self,extra):
+        return Successors(self.tokens,self.cum_weights,self.index,extra)
+        
+    def __len__(self):
+        if not self.extra:
+            return len(self.tokens)
+        return len(self.tokens)+sum(1 for token in self.extra if token not in self.index)
+        
+    def weight(self,token):
+        i = self.index.get(token)
+        weight = 0 if i is None else self.cum_weights[i]-(self.cum_weights[i-1] if i > 0 else 0)
+        if self.extra:
+            weight += self.extra.get(token,0)
+        return weight
+        
+    def sample(self,prefer=None,boost=5):
+        extra = dict(self.extra) if self.extra else {}
+        if prefer:
+            for token in set(prefer):
+                weight = self.weight(token)
+                if weight > 0:
+                    extra[token] = extra.get(token,0)+(boost-1)*weight
+        total = self.cum_weights[-1] if len(self.cum_weights) > 0 else 0
+        r = random.random()*(total+sum(extra.values()))
+        if r < total:
+            return self.tokens[bisect.bisect_right(self.cum_weights,r)]
+        r -= total
+        for token,weight in extra.items():
+            r -= weight
+            if r < 0:
+                break
+        return token
 
 def create_ngram_table(c,depth):
     names = string.ascii_lowercase[:depth+1]
-    c.execute('CREATE TABLE ngrams_%i(%s, count INTEGER);'%(depth,', '.join(['%s TEXT'%var for var in names])))
-    create_index(c,depth,min(4,depth+1))
+    c.execute('CREATE TABLE ngrams_%i(%s, count INTEGER, PRIMARY KEY(%s)) WITHOUT ROWID;'%(depth,', '.join(['%s INTEGER'%var for var in names]),','.join(names)))
     
-def add_statement(depth):
-    ngram = ','.join(['?']*(depth+1))
-    clause = ' AND '.join(['%s is ?' % name for name in string.ascii_lowercase[:depth+1]])
-    return 'INSERT OR REPLACE INTO ngrams_%i VALUES (%s, COALESCE( (SELECT count FROM ngrams_%i WHERE %s), 0) + 1);' % (depth,ngram,depth,clause)
+def is_prefix_keyed(c,depth):
+    sql, = c.execute('SELECT sql FROM sqlite_master WHERE type = \'table\' AND name = ?;',('ngrams_%i'%depth,)).fetchone()
+    return 'WITHOUT ROWID' in sql.upper()
+    
+def rebuild_ngram_table(c,depth):
+    names = ','.join(string.ascii_lowercase[:depth+1])
+    c.execute('ALTER TABLE ngrams_%i RENAME TO ngrams_%i_old;'%(depth,depth))
+    create_ngram_table(c,depth)
+    c.execute('INSERT INTO ngrams_%i SELECT %s,SUM(count) FROM ngrams_%i_old GROUP BY %s ORDER BY %s;'%(depth,names,depth,names,names))
+    c.execute('DROP TABLE ngrams_%i_old;'%(depth,))
+    
+def create_vocab_table(c):
+    c.execute('CREATE TABLE vocab(id INTEGER PRIMARY KEY, token TEXT NOT NULL UNIQUE);')
+    
+def has_table(c,name):
+    return c.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?;',(name,)).fetchone() is not None
     
 def get_statement(depth):
     ngram = ','.join(['?']*(depth+1))
-    clause = ' AND '.join(['%s is ?' % name for name in string.ascii_lowercase[:depth]])
+    clause = ' AND '.join(['%s = ?' % name for name in string.ascii_lowercase[:depth]])
     last = string.ascii_lowercase[depth:depth+1]
     return 'SELECT %s,count FROM ngrams_%i WHERE %s;' % (last,depth,clause)
     
-add_statements = [add_statement(depth) for depth in range(1,10)]
-def add_ngrams(c,ngrams,commit=True):
+def upsert_statement(depth):
+    ngram = ','.join(['?']*(depth+2))
+    return 'INSERT INTO ngrams_%i VALUES (%s) ON CONFLICT DO UPDATE SET count = count + excluded.count;' % (depth,ngram)
+
+upsert_statements = [upsert_statement(depth) for depth in range(1,10)]
+def upsert_ngrams(c,counts,commit=True):
     try:
         if commit:
-            c.execute('BEGIN TRANSACTION;')
-        for igrams,statement in zip(ngrams,add_statements):
-            for igram in igrams:
-                c.execute(statement,igram*2)
+            c.execute('BEGIN IMMEDIATE;')
+        for igrams,statement in zip(counts,upsert_statements):
+            if len(igrams) > 0:
+                c.executemany(statement,[igram+(count,) for igram,count in sorted(igrams.items())])
         if commit:
             c.execute('COMMIT;')
     except:
         if commit:
-            c.execute('ROLLBACK;')   
-        raise 
+            c.execute('ROLLBACK;')
+        raise
 
 get_statements = [get_statement(depth) for depth in range(1,10)]
 def get_next(c,seed):
     depth = len(seed)
     return [(opt,count) for opt,count in c.execute(get_statements[depth-1],seed)]
     
-    
+class LRUCache:
+    def __init__(self,size=50000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self,key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+            
+    def put(self,key,entry,generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                
+    def invalidate(self,keys=None):
+        with self.lock:
+            self.generation += 1
+            if keys is None or len(keys) >= len(self.entries):
+                self.entries.clear()
+            else:
+                for key in keys:
+                    self.entries.pop(key,None)
+                    
+    def stats(self):
+        with self.lock:
+            total = self.hits+self.misses
+            return {'size':len(self.entries),'hits':self.hits,'misses':self.misses,'hit_rate':self.hits/total if total else 0.0}
+
+def strip_nick(text):
+    start = text.find('<')
+    if start == -1:
+        return text
+    if '\n' in text:
+        return nick_remover.sub('',text)
+    end = text.rfind('>')
+    if end < start+2:
+        return text
+    return text[:start]+text[end+1:].lstrip(' ,:')
+
+token_re = re.compile('https?://[^\s]+|\[[^\]]\]|[\w\d`#%\'-]+|['+string.punctuation+'\d]+[\w\d'+string.punctuation+']*',re.I)
+
 class BasicTokenizer:
     def __init__(self):
-        self.re = re.compile('https?://[^\s]+|\[[^\]]\]|[\w\d`#%\'-]+|['+string.punctuation+'\d]+[\w\d'+string.punctuation+']*',re.I)
+        self.re = token_re
     
-    def tokenize(self,text):
+    def tokenize(self,text,strip_nicks=False):
+        if strip_nicks and '<' in text:
+            text = strip_nick(text)
         return self.re.findall(text)
         
-def get_ngram(tokens,start,nlen,maxlen):
-    if start+nlen <= maxlen-1 and start >= 0 :
-        return tokens[start:start+nlen] 
-    else:
-        if start >= 0:
-            return tokens[start:start+nlen-1]+[None]
-        elif start+nlen > maxlen-1:
-            return [None]+tokens+[None]
-        else:
-            return [None]+tokens[:nlen-1]
+    def tokenize_many(self,texts,strip_nicks=False):
+        findall = self.re.findall
+        if strip_nicks:
+            return [findall(text) if '<' not in text else findall(strip_nick(text)) for text in texts]
+        return [findall(text) for text in texts]
+
+tokenizer_corpus = [
+    '', ' ', 'hello world', '<nick> hello there', '<nick>: hi, you', '<a> <b> text', 'a < b and c > d',
+    'x<y>z', '<>', '<x>', '< >', 'no close <bracket', 'close> only', '<nick>,: ,rest', 'multi\n<line> text\n<nick> two',
+    'see https://example.com/a?b=1&c=[2] now', 'http://x', '[a] [ab] [] [\n]', "don't won't 'quoted' -dash- #chan 50%",
+    '...!!! ?! 3.14 1,000 $5 :) :-( <3 ^_^', 'tab\tseparated\ttext', 'ünïcödé wörds 日本語 テキスト', '@user: hey `code`',
+    '<[a]nick|away> message with | pipes', 'trailing space ', '<<double>> angle', 'a<b', '<nick>hello<there>friend',
+]
+
+def reference_tokenize(text):
+    return token_re.findall(nick_remover.sub('',text))
+
+def bench_tokenizer(paths=None,repeat=3):
+    texts = list(tokenizer_corpus)
+    for path in paths or []:
+        with open(path,'rb') as f:
+            texts.extend(line.decode('utf-8',errors='ignore').rstrip('\r\n') for line in f)
+    tknzr = BasicTokenizer()
+    fast = tknzr.tokenize_many(texts,strip_nicks=True)
+    mismatches = [(text,ref,got) for text,ref,got in zip(texts,map(reference_tokenize,texts),fast) if ref != got]
+    for text,ref,got in mismatches[:10]:
+        print('MISMATCH %r: %r != %r' % (text,got,ref))
+    timings = {}
+    for name,func in (('reference',lambda: [reference_tokenize(text) for text in texts]),('tokenize_many',lambda: tknzr.tokenize_many(texts,strip_nicks=True))):
+        best = None
+        for i in range(repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter()-started
+            best = elapsed if best is None else min(best,elapsed)
+        timings[name] = best
+        print('%s: %i lines in %0.3f s (%0.0f lines/s)' % (name,len(texts),best,len(texts)/best if best > 0 else 0))
+    print('%i lines, %i mismatches, %0.2fx speedup' % (len(texts),len(mismatches),timings['reference']/timings['tokenize_many'] if timings['tokenize_many'] > 0 else 0))
+    return len(mismatches) == 0
+        
+def count_ngrams(tokens,counts,ngrams=8):
+    padded = [None]+tokens+[None]
+    for nlen in range(2,min(ngrams,len(padded))+1):
+        counts[nlen-2].update(zip(*[padded[i:] for i in range(nlen)]))
+
+def legacy_index_level(depth,level=None):
+    return min(level,depth+1) if level else min(depth+1,4)
+
+def legacy_index_columns(c,depth):
+    # begin/commit(recreate_index=N) rebuilt the legacy indexes with other widths, so read the real ones
+    return [name for seqno,cid,name in sorted(c.execute("PRAGMA index_info('ngram_%i');" % depth))]
+
+def legacy_statement(depth):
+    ngram = ','.join(['?']*(depth+1))
+    clause = ' AND '.join(['%s is ?' % name for name in string.ascii_lowercase[:depth+1]])
+    return 'INSERT OR REPLACE INTO ngrams_%i VALUES (%s, COALESCE( (SELECT count FROM ngrams_%i WHERE %s), 0) + 1);' % (depth,ngram,depth,clause)
+
+def write_legacy_profile(path,texts,ngrams=8,index_level=None):
+    conn = apsw.Connection(path)
+    c = conn.cursor()
+    c.execute('BEGIN TRANSACTION;')
+    for depth in range(1,10):
+        names = string.ascii_lowercase[:depth+1]
+        c.execute('CREATE TABLE ngrams_%i(%s, count INTEGER);' % (depth,', '.join(['%s TEXT' % name for name in names])))
+        c.execute('CREATE UNIQUE INDEX ngram_%i ON ngrams_%i(%s);' % (depth,depth,','.join(names[:legacy_index_level(depth,index_level)])))
+    statements = [legacy_statement(depth) for depth in range(1,10)]
+    for tokens in BasicTokenizer().tokenize_many(texts,strip_nicks=True):
+        padded = [None]+tokens+[None]
+        for nlen in range(2,min(ngrams,len(padded))+1):
+            for igram in zip(*[padded[i:] for i in range(nlen)]):
+                c.execute(statements[nlen-2],igram*2)
+    c.execute('COMMIT;')
+    conn.close()
+
+def read_profile(path):
+    c = apsw.Connection(path,flags=apsw.SQLITE_OPEN_READONLY).cursor()
+    vocab = dict(c.execute('SELECT id,token FROM vocab;'))
+    vocab[0] = None
+    return [{tuple(vocab[tid] for tid in row[:-1]):row[-1] for row in c.execute('SELECT * FROM ngrams_%i;' % depth)} for depth in range(1,10)]
+
+def check_migrate(paths=None,index_level=None):
+    texts = list(tokenizer_corpus)
+    for path in paths or []:
+        with open(path,'rb') as f:
+            texts.extend(line.decode('utf-8',errors='ignore').rstrip('\r\n') for line in f)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy,migrated,fresh = [os.path.join(tmp,name) for name in ('legacy.sqlite','migrated.sqlite','fresh.sqlite')]
+        write_legacy_profile(legacy,texts,index_level=index_level)
+        c = apsw.Connection(legacy,flags=apsw.SQLITE_OPEN_READONLY).cursor()
+        indexed = [[string.ascii_lowercase.index(name) for name in legacy_index_columns(c,depth)] for depth in range(1,10)]
+        migrate_profile(legacy,migrated)
+        chain = MarkovChain(fresh)
+        chain.process_many(texts)
+        chain.close()
+        ok = True
+        for depth,(got,want) in enumerate(zip(read_profile(migrated),read_profile(fresh)),1):
+            key = lambda ngram: tuple(ngram[i] for i in indexed[depth-1])
+            prefixes = Counter(key(ngram) for ngram in want)
+            # distinct ngrams sharing NULL-free indexed columns replaced each other in the legacy schema
+            lossy = set(ngram for ngram in want if len(indexed[depth-1]) > 0 and prefixes[key(ngram)] > 1 and None not in key(ngram))
+            mismatches = [(ngram,got.get(ngram),count) for ngram,count in want.items() if ngram not in lossy and got.get(ngram) != count]
+            for ngram,count,expected in mismatches[:5]:
+                print('MISMATCH ngrams_%i %r: %r != %r' % (depth,ngram,count,expected))
+            print('ngrams_%i: %i ngrams, %i mismatches, %i not representable in the legacy schema' % (depth,len(want),len(mismatches),len(lossy)))
+            ok = ok and len(mismatches) == 0
+    return ok
+
+def migrate_profile(src,dst,chunk=100000):
+    if os.path.exists(dst):
+        raise RuntimeError('%s already exists' % dst)
+    old = apsw.Connection(src,flags=apsw.SQLITE_OPEN_READONLY)
+    new = apsw.Connection(dst)
+    r,w = old.cursor(),new.cursor()
+    w.execute('PRAGMA synchronous = OFF;')
+    w.execute('BEGIN TRANSACTION;')
+    create_vocab_table(w)
+    vocab = {None:0}
+    def token_id(token):
+        tid = vocab.get(token)
+        if tid is None:
+            tid = vocab[token] = len(vocab)
+            w.execute('INSERT INTO vocab VALUES (?,?);',(tid,token))
+        return tid
+    print('building vocabulary...')
+    for token, in r.execute('SELECT a FROM ngrams_1 UNION SELECT b FROM ngrams_1;'):
+        token_id(token)
+    for depth in range(1,10):
+        print('converting ngrams_%i...' % depth)
+        create_ngram_table(w,depth)
+        names = ','.join(string.ascii_lowercase[:depth+1])
+        # NULL never conflicts in the legacy unique index, so every occurrence with a NULL in
+        # the indexed columns was inserted as its own row with an unreliable running count
+        # (without an index no row ever conflicted)
+        nulls = ' OR '.join('%s IS NULL' % name for name in legacy_index_columns(r,depth)) or '1'
+        rows = r.execute('SELECT %s,CASE WHEN %s THEN COUNT(*) ELSE SUM(count) END FROM ngrams_%i GROUP BY %s;' % (names,nulls,depth,names))
+        insert = 'INSERT INTO ngrams_%i VALUES (%s);' % (depth,','.join(['?']*(depth+2)))
+        while True:
+            batch = [[token_id(token) for token in row[:-1]]+[row[-1]] for row in itertools.islice(rows,chunk)]
+            if len(batch) == 0:
+                break
+            w.executemany(insert,batch)
+    w.execute('COMMIT;')
+    print('migrated',len(vocab)-1,'tokens')
+    
+frozen_magic = b'TBMARKOV'
+frozen_version = 1
+
+class ArrayWriter:
+    def __init__(self,path,dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.f = open(path,'wb')
+        
+    def write(self,values):
+        values = np.ascontiguousarray(values,dtype=self.dtype)
+        self.f.write(values.tobytes())
+        self.size += len(values)
+        
+    def close(self):
+        self.f.close()
+
+def align(offset,to=64):
+    return -(-offset//to)*to
+
+def write_frozen(dst,arrays,meta):
+    layout = {}
+    offset = 0
+    for name,writer in arrays.items():
+        writer.close()
+        layout[name] = {'dtype':writer.dtype.str,'size':writer.size,'offset':offset}
+        offset = align(offset+writer.size*writer.dtype.itemsize)
+    header = json.dumps({'meta':meta,'arrays':layout}).encode('utf-8')
+    start = align(len(frozen_magic)+8+len(header))
+    with open(dst,'wb') as f:
+        f.write(frozen_magic+struct.pack('<II',frozen_version,len(header))+header)
+        for name,writer in arrays.items():
+            f.seek(start+layout[name]['offset'])
+            with open(writer.path,'rb') as src:
+                while True:
+                    data = src.read(1<<24)
+                    if len(data) == 0:
+                        break
+                    f.write(data)
+        f.truncate(start+offset)
+
+def compile_profile(src,dst,chunk=1000000):
+    conn = apsw.Connection(src,flags=apsw.SQLITE_OPEN_READONLY)
+    c = conn.cursor()
+    if not has_table(c,'vocab'):
+        raise RuntimeError('%s uses the old text schema, migrate it first' % src)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dst))) as tmp:
+        arrays = {}
+        def writer(name,dtype):
+            arrays[name] = ArrayWriter(os.path.join(tmp,name),dtype)
+            return arrays[name]
+        print('writing vocabulary...')
+        vocab = {tid:token.encode('utf-8') for tid,token in c.execute('SELECT id,token FROM vocab;')}
+        max_id = max(vocab.keys(),default=0)
+        tokens = [vocab.get(tid,b'') for tid in range(max_id+1)]
+        writer('vocab_blob','u1').write(np.frombuffer(b''.join(tokens),dtype='u1'))
+        writer('vocab_offsets','u8').write(np.concatenate(([0],np.cumsum([len(token) for token in tokens]))))
+        del tokens
+        writer('vocab_order','u4').write(sorted(vocab.keys(),key=vocab.get))
+        del vocab
+        for depth in range(1,10):
+            print('writing ngrams_%i...' % depth)
+            names = ','.join(string.ascii_lowercase[:depth+1])
+            total, = c.execute('SELECT COALESCE(SUM(count),0) FROM ngrams_%i;' % depth).fetchone()
+            keys = [writer('keys_%i_%i'%(depth,col),'u4') for col in range(depth)]
+            starts = writer('starts_%i'%depth,'u8')
+            succ = writer('next_%i'%depth,'u4')
+            cum = writer('cum_%i'%depth,'u4' if total < 1<<32 else 'u8')
+            rows = c.execute('SELECT %s,count FROM ngrams_%i ORDER BY %s;' % (names,depth,names))
+            last,carry,row = None,0,0
+            while True:
+                batch = np.array(list(itertools.islice(rows,chunk)),dtype='i8').reshape(-1,depth+2)
+                if len(batch) == 0:
+                    break
+                prefix,counts = batch[:,:depth],batch[:,-1]
+                is_start = np.empty(len(batch),dtype=bool)
+                is_start[0] = last is None or bool(np.any(prefix[0] != last))
+                is_start[1:] = np.any(prefix[1:] != prefix[:-1],axis=1)
+                first = np.flatnonzero(is_start)
+                running = np.cumsum(counts)
+                base = np.concatenate(([-carry],(running-counts)[first]))
+                within = running-base[np.cumsum(is_start)]
+                for col,key in enumerate(keys):
+                    key.write(prefix[first,col])
+                starts.write(first+row)
+                succ.write(batch[:,depth])
+                cum.write(within)
+                last,carry,row = prefix[-1],within[-1],row+len(batch)
+            starts.write([row])
+        write_frozen(dst,arrays,{'source':os.path.basename(src)})
+    print('compiled',src,'to',dst)
+
+def count_shard(args):
+    path,start,end,ngrams,strip = args
+    tknzr = BasicTokenizer()
+    counts = [Counter() for depth in range(1,10)]
+    lines = 0
+    for text in shard_lines(path,start,end,strip):
+        count_ngrams(tknzr.tokenize(text,strip_nicks=True),counts,ngrams)
+        lines += 1
+    return lines,end-start,counts
 
-class MarkovChain:
-    def __init__(self,dbfile='markov.sqlite'):
+def train_profile(dst,paths,workers=None,ngrams=8,shard_size=16<<20,strip=None,max_ngrams=20000000):
+    chain = MarkovChain(dst)
+    chain.conn.cursor().execute('PRAGMA synchronous = OFF;')
+    shards = [shard+(ngrams,strip) for shard in log_shards(paths,shard_size)]
+    totals = [Counter() for depth in range(1,10)]
+    lines,nbytes,started = 0,0,time.time()
+    chain.begin()
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for ishard,(shard_lines,shard_bytes,counts) in enumerate(pool.imap_unordered(count_shard,shards),1):
+                for total,igrams in zip(totals,counts):
+                    total.update(igrams)
+                lines += shard_lines
+                nbytes += shard_bytes
+                elapsed = time.time()-started
+                print('shard %i/%i: %i lines, %0.1f MB, %0.0f lines/s, %0.2f MB/s' % (ishard,len(shards),lines,nbytes/1e6,lines/elapsed,nbytes/1e6/elapsed))
+                if sum(len(total) for total in totals) > max_ngrams:
+                    print('writing',sum(len(total) for total in totals),'ngrams...')
+                    chain.write_counts(totals)
+                    totals = [Counter() for depth in range(1,10)]
+        print('writing',sum(len(total) for total in totals),'ngrams...')
+        chain.write_counts(totals)
+        chain.commit()
+    except:
+        chain.txn.execute('ROLLBACK;')
+        chain.txn = None
+        raise
+    finally:
+        chain.close()
+    print('trained %s on %i lines in %0.1f s' % (dst,lines,time.time()-started))
+
+writer_pragmas = ['PRAGMA journal_mode = WAL;','PRAGMA synchronous = NORMAL;','PRAGMA cache_size = -65536;','PRAGMA mmap_size = 268435456;']
+reader_pragmas = ['PRAGMA cache_size = -16384;','PRAGMA mmap_size = 268435456;']
+# milliseconds to wait for another writer (a second bot, compact or train) before raising BusyError
+busy_timeout = 5000
+
+chains = {}
+chains_lock = threading.Lock()
+def open_chain(path='markov.sqlite'):
+    key = os.path.abspath(path)
+    with chains_lock:
+        chain = chains.get(key)
+        if chain is None:
+            chain = chains[key] = FrozenMarkovChain(path) if path.endswith('.markov') else MarkovChain(path)
+        return chain
+        
+def forget_chain(chain,path):
+    with chains_lock:
+        if chains.get(os.path.abspath(path)) is chain:
+            del chains[os.path.abspath(path)]
+
+def rejoin_chain(chain):
+    if not isinstance(chain,MarkovChain):
+        return chain
+    shared = open_chain(chain.dbfile)
+    if shared is not chain:
+        chain.close()
+    return shared
+
+live_chains = weakref.WeakSet()
+@atexit.register
+def flush_all():
+    for chain in list(live_chains):
+        chain.flush()
+
+def detokenize(tokens):
+    return ''.join([' '+i if not i.startswith("'") and i not in string.punctuation else i for i in tokens if i]).strip()
+    
+def overlap_score(guess,tokens):
+    return len(set(guess) & set(tokens))
+
+class BaseMarkovChain:
+    def cursor(self):
+        return None
+        
+    def successors(self,c,seed):
+        raise NotImplementedError()
+        
+    def extend(self,seed,min_choices=2,start_depth=8,min_depth=1,prefer=None):
+        if start_depth > len(seed):
+            start_depth = len(seed)
+        c = self.cursor()
+        for depth in range(start_depth,min_depth-1,-1):
+            succ = self.successors(c,seed[-depth:])
+            if depth > 1 and len(succ) < min_choices:
+                continue
+            if depth == 1 and len(succ) == 0:
+                return None
+            return succ.sample(prefer)
+        return None
+          
+    def find_seed(self,tokens,min_choices=2,start_depth=8,min_depth=2):    
+        c = self.cursor()
+        for depth in range(start_depth,min_depth-1,-1):
+            for attempt in range(50):
+                seed = [None]+random.choices(tokens,k=depth-1)
+                if len(self.successors(c,seed)) > min_choices:
+                    return seed
+        return None
+                      
+    def gen_candidate(self,tokens,deadline,max_tokens=50,min_extend_choices=2,start_depth=8,min_depth=1):
+        guess = [None]
+        while len(guess) <= max_tokens and time.perf_counter() < deadline:
+            token = self.extend(guess,min_choices=min_extend_choices,start_depth=start_depth,min_depth=min_depth,prefer=tokens)
+            if not token:
+                break
+            guess.append(token)
+        return guess[1:]
+                      
+    def gen_reply(self,text,min_seed_choices=3,min_extend_choices=2,start_depth=8,min_depth=1,max_tokens=50,max_time=1.0,candidates=1,score=None):
+        started = time.perf_counter()
+        tokens = self.tknzr.tokenize(text)
+        if len(tokens) < 1:
+            return None
+        deadline = started+max_time if max_time else float('inf')
+        score = score or overlap_score
+        best,best_score,tried = [],None,0
+        while tried < candidates and (tried == 0 or time.perf_counter() < deadline):
+            guess = self.gen_candidate(tokens,deadline,max_tokens,min_extend_choices,start_depth,min_depth)
+            tried += 1
+            if len(guess) > 0:
+                guess_score = score(guess,tokens)
+                if best_score is None or guess_score > best_score:
+                    best,best_score = guess,guess_score
+        elapsed = time.perf_counter()-started
+        self.reply_stats.append({'time':elapsed,'tokens':len(best),'candidates':tried,'timed_out':elapsed >= (max_time or float('inf'))})
+        return detokenize(best)
+        
+    def timing_stats(self):
+        times = [stats['time'] for stats in self.reply_stats]
+        if len(times) == 0:
+            return {'replies':0}
+        return {'replies':len(times),'mean':sum(times)/len(times),'max':max(times),'timed_out':sum(stats['timed_out'] for stats in self.reply_stats)}
+
+class MarkovChain(BaseMarkovChain):
+    def __init__(self,dbfile='markov.sqlite',flush_size=20000,flush_interval=60.0,cache_size=50000):
         self.dbfile = dbfile
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
         self._init()
         
     def _init(self):
         self.tknzr = BasicTokenizer()
-        if os.path.exists(self.dbfile):
-            self.conn = apsw.Connection(self.dbfile)
+        exists = os.path.exists(self.dbfile)
+        self.conn = apsw.Connection(self.dbfile)
+        self.conn.setbusytimeout(busy_timeout)
+        c = self.conn.cursor()
+        if exists:
+            if not has_table(c,'vocab'):
+                raise RuntimeError('%s uses the old text schema, convert it with: python markov.py migrate %s <new file>' % (self.dbfile,self.dbfile))
         else:
-            self.conn = apsw.Connection(self.dbfile)
-            c = self.conn.cursor()
+            create_vocab_table(c)
             for depth in range(1,10):
                 create_ngram_table(c,depth)
+        for pragma in writer_pragmas:
+            c.execute(pragma)
+        self.readers = threading.local()
+        self.reader_conns = []
         self.txn = None
+        self._forget_tokens()
+        self.cache = LRUCache(self.cache_size)
+        self.reply_stats = deque(maxlen=100)
+        self.pending = [{} for depth in range(1,10)]
+        self.pending_size = 0
+        self.pending_lock = threading.RLock()
+        self.last_flush = time.time()
+        live_chains.add(self)
+        
+    def cursor(self):
+        conn = getattr(self.readers,'conn',None)
+        if conn is None:
+            conn = self.readers.conn = apsw.Connection(self.dbfile,flags=apsw.SQLITE_OPEN_READONLY)
+            conn.setbusytimeout(busy_timeout)
+            c = conn.cursor()
+            for pragma in reader_pragmas:
+                c.execute(pragma)
+            with self.pending_lock:
+                self.reader_conns.append(conn)
+        return conn.cursor()
     
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['txn']
-        del state['conn']
-        return state
+    def __reduce__(self):
+        self.flush()
+        return (open_chain,(self.dbfile,))
         
     def __setstate__(self,state):
-        self.__dict__.update(state)
-        self._init()
+        # chains pickled before open_chain existed carry only dbfile and the tokenizer
+        self.__init__(state['dbfile'])
         
+    def profile_size(self):
+        c = self.conn.cursor()
+        pages, = c.execute('PRAGMA page_count;').fetchone()
+        page_size, = c.execute('PRAGMA page_size;').fetchone()
+        rows = [c.execute('SELECT COUNT(*) FROM ngrams_%i;' % depth).fetchone()[0] for depth in range(1,10)]
+        return {'bytes':pages*page_size,'rows':rows}
+        
+    def compact(self,min_count=2,from_depth=5,decay=None,vacuum=True):
+        if self.txn is not None:
+            raise RuntimeError('cannot compact during a bulk transaction')
+        self.flush()
+        before = self.profile_size()
+        with self.pending_lock:
+            c = self.conn.cursor()
+            c.execute('BEGIN IMMEDIATE;')
+            try:
+                for depth in range(1,10):
+                    if decay is not None:
+                        c.execute('UPDATE ngrams_%i SET count = CAST(count*? AS INTEGER);' % depth,(decay,))
+                    threshold = min_count.get(depth,1) if isinstance(min_count,dict) else (min_count if depth >= from_depth else 1)
+                    c.execute('DELETE FROM ngrams_%i WHERE count < ?;' % depth,(max(threshold,1),))
+                c.execute('COMMIT;')
+            except:
+                c.execute('ROLLBACK;')
+                raise
+            finally:
+                self.cache.invalidate()
+            if vacuum:
+                c.execute('VACUUM;')
+                c.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        after = self.profile_size()
+        print('compacted %s: %0.1f MB -> %0.1f MB' % (self.dbfile,before['bytes']/1e6,after['bytes']/1e6))
+        for depth,(rows_before,rows_after) in enumerate(zip(before['rows'],after['rows']),1):
+            print('  ngrams_%i: %i -> %i rows' % (depth,rows_before,rows_after))
+        return before,after
+        
+    def rebuild_tables(self,c):
+        for depth in range(1,10):
+            if not is_prefix_keyed(c,depth):
+                print('rebuilding ngrams_%i as a prefix keyed table...' % depth)
+                rebuild_ngram_table(c,depth)
+                
     def begin(self,recreate_index=None):
         self.txn = self.conn.cursor()
         if recreate_index is not None:
-            self.txn.execute('BEGIN TRANSACTION;')
-            print('creating simplified index...')
-            for depth in range(1,10):
-                drop_index(self.txn,depth)
-                create_index(self.txn,depth,level=min(recreate_index,depth+1))
+            self.txn.execute('BEGIN IMMEDIATE;')
+            self.rebuild_tables(self.txn)
             self.txn.execute('COMMIT;')
-        self.txn.execute('BEGIN TRANSACTION;')
+        self.txn.execute('BEGIN IMMEDIATE;')
 
     def process(self,text,ngrams=8):
-        text = nick_remover.sub('',text)
-        tokens = self.tknzr.tokenize(text)
-        c = self.conn.cursor() if self.txn is None else self.txn
-        maxlen = len(tokens)+1
-        ngrams = [[get_ngram(tokens,start,nlen,maxlen) for start in range(-1,maxlen-nlen+1)] for nlen in range(2,min(ngrams+1,maxlen+2))]
-        add_ngrams(c,ngrams,commit=(self.txn is None))
+        self.buffer_texts([text],ngrams)
+        
+    def buffer_texts(self,texts,ngrams=8):
+        counts = [Counter() for depth in range(1,10)]
+        for tokens in self.tknzr.tokenize_many(texts,strip_nicks=True):
+            count_ngrams(tokens,counts,ngrams)
+        with self.pending_lock:
+            for igrams,pending in zip(counts,self.pending):
+                for igram,count in igrams.items():
+                    succ = pending.get(igram[:-1])
+                    if succ is None:
+                        succ = pending[igram[:-1]] = Counter()
+                    succ[igram[-1]] += count
+                self.pending_size += len(igrams)
+            if self.pending_size >= self.flush_size or time.time()-self.last_flush >= self.flush_interval:
+                self.flush()
+                
+    def _forget_tokens(self):
+        self.token_ids = {None:0}
+        self.id_tokens = {0:None}
+        
+    def _remember_token(self,token,tid):
+        self.token_ids[token] = tid
+        self.id_tokens[tid] = token
+    
+    def intern(self,c,tokens):
+        ids = []
+        for token in tokens:
+            tid = self.token_ids.get(token)
+            if tid is None:
+                row = c.execute('SELECT id FROM vocab WHERE token = ?;',(token,)).fetchone()
+                if row is None:
+                    row = c.execute('INSERT INTO vocab(token) VALUES (?) RETURNING id;',(token,)).fetchone()
+                tid = row[0]
+                self._remember_token(token,tid)
+            ids.append(tid)
+        return ids
+        
+    def lookup_ids(self,c,tokens):
+        ids = []
+        for token in tokens:
+            tid = self.token_ids.get(token)
+            if tid is None:
+                row = c.execute('SELECT id FROM vocab WHERE token = ?;',(token,)).fetchone()
+                if row is None:
+                    return None
+                tid = row[0]
+                self._remember_token(token,tid)
+            ids.append(tid)
+        return ids
+        
+    def lookup_tokens(self,c,ids):
+        missing = set(tid for tid in ids if tid not in self.id_tokens)
+        if len(missing) > 0:
+            for tid,token in c.execute('SELECT id,token FROM vocab WHERE id IN (%s);' % ','.join(str(tid) for tid in missing)):
+                self._remember_token(token,tid)
+        return [self.id_tokens[tid] for tid in ids]
+        
+    def write_counts(self,counts):
+        with self.pending_lock:
+            self._write_counts(counts)
+            
+    def _write_counts(self,counts):
+        commit = self.txn is None
+        c = self.conn.cursor() if commit else self.txn
+        try:
+            if commit:
+                c.execute('BEGIN IMMEDIATE;')
+            vocab = set(token for igrams in counts for igram in igrams for token in igram)
+            vocab = dict(zip(vocab,self.intern(c,vocab)))
+            upsert_ngrams(c,[{tuple(vocab[token] for token in igram):count for igram,count in igrams.items()} for igrams in counts],commit=False)
+            if commit:
+                c.execute('COMMIT;')
+            changed = sum(len(igrams) for igrams in counts)
+            self.cache.invalidate(None if changed > self.cache.size else set(igram[:-1] for igrams in counts for igram in igrams))
+        except:
+            if commit:
+                c.execute('ROLLBACK;')
+                self._forget_tokens()
+            raise
+    
+    def flush(self):
+        with self.pending_lock:
+            try:
+                if self.pending_size > 0:
+                    self.write_counts([{prefix+(token,):count for prefix,succ in pending.items() for token,count in succ.items()} for pending in self.pending])
+                    self.pending = [{} for depth in range(1,10)]
+                    self.pending_size = 0
+            finally:
+                # a failed write keeps the counts and is retried after another flush_interval
+                self.last_flush = time.time()
+            
+    def flush_delay(self):
+        with self.pending_lock:
+            return None if self.pending_size == 0 else max(0.0,self.last_flush+self.flush_interval-time.time())
+            
+    def close(self):
+        close_service(self)
+        self.flush()
+        live_chains.discard(self)
+        forget_chain(self,self.dbfile)
+        with self.pending_lock:
+            for conn in self.reader_conns:
+                conn.close()
+            self.reader_conns = []
+            self.readers = threading.local()
+        self.conn.close()
+
+    def process_many(self,texts,ngrams=8,batch=100000):
+        texts = iter(texts)
+        while True:
+            chunk = list(itertools.islice(texts,batch))
+            if len(chunk) == 0:
+                break
+            counts = [Counter() for depth in range(1,10)]
+            for tokens in self.tknzr.tokenize_many(chunk,strip_nicks=True):
+                count_ngrams(tokens,counts,ngrams)
+            self.write_counts(counts)
         
     def commit(self,recreate_index=None):
         if self.txn:
+            self.flush()
             self.txn.execute('COMMIT;')
             if recreate_index is not None:
-                self.txn.execute('BEGIN TRANSACTION;')
-                print('regenerating full index...')
-                for depth in range(1,10):
-                    drop_index(self.txn,depth)
-                    create_index(self.txn,depth,recreate_index)
+                self.txn.execute('BEGIN IMMEDIATE;')
+                self.rebuild_tables(self.txn)
                 self.txn.execute('COMMIT;')
             self.txn = None
         
-    def extend(self,seed,min_choices=2,start_depth=8,min_depth=1,prefer=None):
-        if start_depth > len(seed):
-            start_depth = len(seed)
-        c = self.conn.cursor()
-        for depth in range(start_depth,min_depth-1,-1):
-            opts = get_next(c,seed[-depth:])
-            if depth > 1 and len(opts) < min_choices:
-                continue
-            if depth == 1 and len(opts) == 0:
+    def successors(self,c,seed):
+        key = tuple(seed)
+        entry = self.cache.get(key)
+        if entry is None:
+            generation = self.cache.generation
+            ids = self.lookup_ids(c,seed)
+            opts = get_next(c,ids) if ids is not None else []
+            entry = Successors(self.lookup_tokens(c,[tid for tid,count in opts]),list(itertools.accumulate(count for tid,count in opts)))
+            self.cache.put(key,entry,generation)
+        with self.pending_lock:
+            succ = self.pending[len(seed)-1].get(key)
+            if succ:
+                entry = entry.with_extra(dict(succ))
+        return entry
+
+
+class FrozenMarkovChain(BaseMarkovChain):
+    def __init__(self,path,cache_size=50000):
+        self.path = path
+        self.cache_size = cache_size
+        self._init()
+        
+    def _init(self):
+        self.tknzr = BasicTokenizer()
+        with open(self.path,'rb') as f:
+            self.mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        magic = self.mm[:len(frozen_magic)]
+        version,header_len = struct.unpack('<II',self.mm[len(frozen_magic):len(frozen_magic)+8])
+        if magic != frozen_magic or version != frozen_version:
+            raise RuntimeError('%s is not a compiled markov profile' % self.path)
+        header = json.loads(self.mm[len(frozen_magic)+8:len(frozen_magic)+8+header_len].decode('utf-8'))
+        start = align(len(frozen_magic)+8+header_len)
+        self.arrays = {name:np.frombuffer(self.mm,dtype=spec['dtype'],count=spec['size'],offset=start+spec['offset']) for name,spec in header['arrays'].items()}
+        self.meta = header['meta']
+        self.keys = [None]+[[self.arrays['keys_%i_%i'%(depth,col)] for col in range(depth)] for depth in range(1,10)]
+        self.token_ids = {None:0}
+        self.id_tokens = {0:None}
+        self.cache = LRUCache(self.cache_size)
+        self.reply_stats = deque(maxlen=100)
+        
+    def __reduce__(self):
+        return (open_chain,(self.path,))
+        
+    def close(self):
+        close_service(self)
+        forget_chain(self,self.path)
+        self.arrays = None
+        self.keys = None
+        self.cache.invalidate()
+        self.mm.close()
+        
+    def token_bytes(self,tid):
+        offsets = self.arrays['vocab_offsets']
+        return self.arrays['vocab_blob'][offsets[tid]:offsets[tid+1]].tobytes()
+        
+    def token(self,tid):
+        if tid not in self.id_tokens:
+            self.id_tokens[tid] = self.token_bytes(tid).decode('utf-8')
+        return self.id_tokens[tid]
+        
+    def token_id(self,token):
+        tid = self.token_ids.get(token)
+        if tid is None:
+            key = token.encode('utf-8')
+            order = self.arrays['vocab_order']
+            lo,hi = 0,len(order)
+            while lo < hi:
+                mid = (lo+hi)//2
+                if self.token_bytes(order[mid]) < key:
+                    lo = mid+1
+                else:
+                    hi = mid
+            if lo == len(order) or self.token_bytes(order[lo]) != key:
+                return None
+            tid = self.token_ids[token] = int(order[lo])
+        return tid
+        
+    def find_prefix(self,ids):
+        keys = self.keys[len(ids)]
+        lo,hi = 0,len(keys[0])
+        for key,tid in zip(keys,ids):
+            part = key[lo:hi]
+            lo,hi = lo+np.searchsorted(part,tid,'left'),lo+np.searchsorted(part,tid,'right')
+            if lo == hi:
                 return None
-            if prefer is None:
-                weights = [weight for token,weight in opts]
+        return lo
+        
+    def successors(self,c,seed):
+        key = tuple(seed)
+        entry = self.cache.get(key)
+        if entry is None:
+            ids = [self.token_id(token) for token in seed]
+            group = None if None in ids else self.find_prefix(ids)
+            if group is None:
+                entry = Successors([],[])
             else:
-                weights = [weight if token not in prefer else 5*weight for token,weight in opts]
-            tokens = [token for token,weight in opts]
-            return choices(tokens,weights)[0]
-        return None
-          
-    def find_seed(self,tokens,min_choices=2,start_depth=8,min_depth=2):    
-        c = self.conn.cursor()    
-        for depth in range(start_depth,min_depth-1,-1):
-            for attempt in range(50):
-                seed = [None]+choices(tokens,k=depth-1)
-                opts = get_next(c,seed)
-                if len(opts) > min_choices:
-                    return seed
-        return None
-                      
-    def gen_reply(self,text,min_seed_choices=3,min_extend_choices=2,start_depth=8,min_depth=1):
-        tokens = self.tknzr.tokenize(text)
-        if len(tokens) < 1:
-            return None
-        print('attempt: ',end='')
-        guess = [None]
+                depth = len(seed)
+                starts = self.arrays['starts_%i'%depth]
+                start,end = int(starts[group]),int(starts[group+1])
+                entry = Successors([self.token(tid) for tid in self.arrays['next_%i'%depth][start:end].tolist()],self.arrays['cum_%i'%depth][start:end].tolist())
+            self.cache.put(key,entry)
+        return entry
+
+class MarkovService:
+    def __init__(self,chain,max_queue=10000):
+        self.chain = chain
+        self.workers = ThreadPoolExecutor(max_workers=1)
+        self.learn_queue = deque()
+        self.max_queue = max_queue
+        self.reply_queue = deque()
+        self.wakeup = None
+        self.task = None
+        self.learned = 0
+        self.batches = 0
+        self.dropped = 0
+        self.flush_failed = False
+        
+    def _wake(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        self.wakeup.set()
+        
+    async def learn(self,text):
+        if len(self.learn_queue) >= self.max_queue:
+            print('LQ',self.learn_queue.popleft())
+            self.dropped += 1
+        self.learn_queue.append(text)
+        self._wake()
+        
+    async def reply(self,text,**kwargs):
+        future = asyncio.get_event_loop().create_future()
+        self.reply_queue.append((text,kwargs,future))
+        self._wake()
+        return await future
+        
+    async def run(self):
+        loop = asyncio.get_event_loop()
         while True:
-            next = self.extend(guess,min_choices=min_extend_choices,start_depth=start_depth,min_depth=min_depth,prefer=tokens)
-            print(next,end=' ')
-            if next:
-                guess.append(next)
-            else:
-                break
-        print()
-        return ''.join([' '+i if not i.startswith("'") and i not in string.punctuation else i for i in guess if i]).strip()
+            delay = self.chain.flush_delay() if isinstance(self.chain,MarkovChain) else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),timeout=delay)
+            except asyncio.TimeoutError:
+                # nothing learned since the buffer went stale, write it out without waiting for another line
+                try:
+                    await loop.run_in_executor(self.workers,self.chain.flush)
+                except Exception:
+                    if not self.flush_failed:
+                        traceback.print_exc()
+                    self.flush_failed = True
+                else:
+                    if self.flush_failed:
+                        print('markov flush recovered')
+                    self.flush_failed = False
+                continue
+            self.wakeup.clear()
+            while len(self.reply_queue) > 0 or len(self.learn_queue) > 0:
+                if len(self.reply_queue) > 0:
+                    text,kwargs,future = self.reply_queue.popleft()
+                    if future.cancelled():
+                        continue
+                    try:
+                        result = await loop.run_in_executor(self.workers,functools.partial(self.chain.gen_reply,text,**kwargs))
+                    except Exception as e:
+                        if not future.cancelled():
+                            future.set_exception(e)
+                    else:
+                        if not future.cancelled():
+                            future.set_result(result)
+                else:
+                    texts = list(self.learn_queue)
+                    self.learn_queue.clear()
+                    try:
+                        await loop.run_in_executor(self.workers,self.chain.buffer_texts,texts)
+                        self.learned += len(texts)
+                        self.batches += 1
+                    except Exception:
+                        traceback.print_exc()
+                        
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        for text,kwargs,future in self.reply_queue:
+            future.cancel()
+        self.reply_queue.clear()
+        self.workers.shutdown(wait=False)
+
+# a service holds its chain, so entries are dropped by close_service when the chain is closed
+services = {}
+def open_service(chain):
+    service = services.get(chain)
+    if service is None:
+        service = services[chain] = MarkovService(chain)
+    return service
+    
+def close_service(chain):
+    service = services.pop(chain,None)
+    if service is not None:
+        service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Markov chain profile tools')
+    commands = parser.add_subparsers(dest='command',required=True)
+    migrate = commands.add_parser('migrate',help='convert a text schema profile to the integer token schema')
+    migrate.add_argument('src')
+    migrate.add_argument('dst')
+    compile = commands.add_parser('compile',help='compile a profile to a read-only memory mapped model')
+    compile.add_argument('src')
+    compile.add_argument('dst')
+    train = commands.add_parser('train',help='build or extend a profile from log files using a process pool')
+    train.add_argument('dst')
+    train.add_argument('logs',nargs='+')
+    train.add_argument('--workers',type=int,default=None,help='worker processes (default: all cores)')
+    train.add_argument('--ngrams',type=int,default=8)
+    train.add_argument('--shard-size',type=int,default=16,help='shard size in MB')
+    train.add_argument('--strip',default=None,help='regex removed from each line before tokenizing, e.g. timestamps')
+    train.add_argument('--max-ngrams',type=int,default=20000000,help='distinct ngrams held in memory before writing')
+    compact = commands.add_parser('compact',help='prune rare ngrams, optionally decay old counts, and vacuum a profile')
+    compact.add_argument('profile')
+    compact.add_argument('--min-count',type=int,default=2,help='delete ngrams with a count below this')
+    compact.add_argument('--from-depth',type=int,default=5,help='only prune tables of at least this depth')
+    compact.add_argument('--decay',type=float,default=None,help='multiply all counts by this factor before pruning')
+    compact.add_argument('--no-vacuum',action='store_true')
+    check = commands.add_parser('check-migrate',help='migrate a legacy profile built from a corpus and compare it with a fresh one')
+    check.add_argument('corpus',nargs='*',help='extra text files to learn, one message per line')
+    check.add_argument('--index-level',type=int,default=None,help='build the legacy indexes this wide, as begin(recreate_index=N) did')
+    bench = commands.add_parser('bench-tokenizer',help='check the tokenizer against the reference regex path and time both')
+    bench.add_argument('corpus',nargs='*',help='extra text files to tokenize, one message per line')
+    args = parser.parse_args(argv)
+    if args.command == 'migrate':
+        migrate_profile(args.src,args.dst)
+    elif args.command == 'compile':
+        compile_profile(args.src,args.dst)
+    elif args.command == 'train':
+        train_profile(args.dst,args.logs,workers=args.workers,ngrams=args.ngrams,shard_size=args.shard_size<<20,strip=args.strip,max_ngrams=args.max_ngrams)
+    elif args.command == 'compact':
+        chain = MarkovChain(args.profile)
+        chain.compact(min_count=args.min_count,from_depth=args.from_depth,decay=args.decay,vacuum=not args.no_vacuum)
+        chain.close()
+    elif args.command == 'check-migrate':
+        sys.exit(0 if check_migrate(args.corpus,args.index_level) else 1)
+    elif args.command == 'bench-tokenizer':
+        sys.exit(0 if bench_tokenizer(args.corpus) else 1)
         
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import os
+import asyncio
+import traceback
+import numpy as np
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+c_start = 96
+c_stop = 97
+c_size = 97
+
+def c2i(c):
+    if len(c) != 1:
+        return None
+    i = ord(c)
+    return i-32+1 if i >= 32 and i <= 126 else None
+
+def i2c(i):
+    return chr(i+32-1) if i >= 1 and i <= 95 else ''
+
+encode_table = np.zeros(256,dtype='uint8')
+encode_table[32:127] = np.arange(1,96)
+decode_table = np.zeros(c_size+1,dtype='uint8')
+decode_table[1:96] = np.arange(32,127)
+
+def encode_texts(msgs,seed=False):
+    raw = [msg.encode('utf-8') for msg in msgs]
+    byte_offsets = np.zeros(len(raw)+1,dtype='int64')
+    np.cumsum([len(b) for b in raw],out=byte_offsets[1:])
+    codes = encode_table[np.frombuffer(b''.join(raw),dtype='uint8')]
+    valid = codes != 0
+    cum_valid = np.zeros(len(codes)+1,dtype='int64')
+    np.cumsum(valid,out=cum_valid[1:])
+    counts = cum_valid[byte_offsets[1:]]-cum_valid[byte_offsets[:-1]]
+    extra = 1 if seed else 2
+    offsets = np.zeros(len(raw)+1,dtype='int64')
+    np.cumsum(counts+extra,out=offsets[1:])
+    out = np.empty(offsets[-1],dtype='uint8')
+    out[offsets[:-1]] = c_start
+    if not seed:
+        out[offsets[1:]-1] = c_stop
+    out[np.arange(np.sum(counts))+extra*np.repeat(np.arange(len(raw)),counts)+1] = codes[valid]
+    return out,offsets
+
+def decode_codes(codes):
+    return decode_table[np.clip(np.asarray(codes),0,c_size)].tobytes().replace(b'\0',b'').decode('ascii')
+
+def sample_states(states,temperature=0.2,rng=np.random):
+    with np.errstate(divide='ignore'):
+        logits = np.log(np.asarray(states,dtype='float64'))/temperature
+    return np.argmax(logits-np.log(-np.log(rng.uniform(size=logits.shape))),axis=-1)+1
+
+def sample_state(state,temperature=0.2):
+    return i2c(sample_states(state,temperature))
+
+def encode_message(msg,seed=False,ngram_size=None):
+    msg = encode_texts([msg],seed)[0].tolist()
+    if ngram_size is not None:
+        if len(msg)>ngram_size:
+            msg = msg[:ngram_size]
+        else:
+            msg += [0]*(ngram_size-len(msg))
+    return np.asarray(msg)
+
+def decode_batch(decode_step,states,seeds,maxlen=100,temp=0.5):
+    forced = [encode_message(seed,seed=True) for seed in seeds]
+    generated = list(seeds)
+    done = [len(seed) >= maxlen for seed in seeds]
+    chars = np.zeros(len(seeds),dtype='int32')
+    step = 0
+    while not all(done):
+        for row,codes in enumerate(forced):
+            if step < len(codes):
+                chars[row] = codes[step]
+        guess,states = decode_step(chars,states)
+        step += 1
+        sampled = sample_states(guess,temperature=temp)
+        for row,codes in enumerate(forced):
+            if done[row] or step < len(codes):
+                continue
+            c = i2c(sampled[row])
+            if len(c) == 0:
+                done[row] = True
+                continue
+            chars[row] = sampled[row]
+            generated[row] += c
+            done[row] = len(generated[row]) >= maxlen
+    return generated
+
+activations = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1/(1+np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(0.2*x+0.5,0,1),
+    'relu': lambda x: np.maximum(x,0),
+}
+
+def softmax(x):
+    x = np.exp(x-np.max(x,axis=-1,keepdims=True))
+    return x/np.sum(x,axis=-1,keepdims=True)
+
+class LiteLanguageCenter:
+    def __init__(self,model='nn.npz'):
+        self.model_name = model
+        with np.load(model) as weights:
+            self.embedding = weights['embedding']
+            self.lstm = []
+            i = 0
+            while 'lstm_%i_kernel'%i in weights:
+                prefix = 'lstm_%i_'%i
+                self.lstm.append((weights[prefix+'kernel'],weights[prefix+'recurrent_kernel'],weights[prefix+'bias'],
+                                  activations[str(weights[prefix+'activation'])],activations[str(weights[prefix+'recurrent_activation'])]))
+                i += 1
+            self.dense = []
+            i = 0
+            while 'dense_%i_kernel'%i in weights:
+                prefix = 'dense_%i_'%i
+                self.dense.append((weights[prefix+'kernel'],weights[prefix+'bias'],activations[str(weights[prefix+'activation'])]))
+                i += 1
+            self.dense.append((weights['letter_out_kernel'],weights['letter_out_bias'],softmax))
+        if len(self.lstm) == 0:
+            raise RuntimeError('%s has no LSTM layers'%model)
+
+    def decode_step(self,chars,states):
+        x = self.embedding[np.asarray(chars)]
+        next_states = []
+        for (kernel,recurrent_kernel,bias,activation,recurrent_activation),h,c in zip(self.lstm,states[0::2],states[1::2]):
+            z = x @ kernel + h @ recurrent_kernel + bias
+            i,f,g,o = np.split(z,4,axis=-1)
+            c = recurrent_activation(f)*c + recurrent_activation(i)*activation(g)
+            h = recurrent_activation(o)*activation(c)
+            next_states += [h,c]
+            x = h
+        x = np.concatenate([h,h,c],axis=-1)
+        for kernel,bias,activation in self.dense:
+            x = activation(x @ kernel + bias)
+        return x,next_states
+
+    def generate(self,seed='',maxlen=100,temp=0.5,verbose=False):
+        generated = self.generate_batch([seed],maxlen=maxlen,temp=temp)[0]
+        if verbose:
+            print(generated,flush=True)
+        return generated
+
+    def initial_states(self,batch):
+        states = []
+        for kernel,recurrent_kernel,bias,activation,recurrent_activation in self.lstm:
+            states += [np.zeros((batch,recurrent_kernel.shape[0]),dtype=recurrent_kernel.dtype)]*2
+        return states
+        
+    def generate_batch(self,seeds,maxlen=100,temp=0.5):
+        return decode_batch(self.decode_step,self.initial_states(len(seeds)),seeds,maxlen=maxlen,temp=temp)
+
+def model_available(npz='nn.npz',h5='nn.h5'):
+    return os.path.exists(npz) or os.path.exists(h5)
+
+def load_language_center(npz='nn.npz',h5='nn.h5'):
+    if os.path.exists(npz):
+        return LiteLanguageCenter(model=npz)
+    import nntextgen
+    return nntextgen.LanguageCenter(model=h5)
+
+class NeuralService:
+    def __init__(self,loader=load_language_center,cache_size=256,max_batch=16):
+        self.loader = loader
+        self.model = None
+        self.workers = ThreadPoolExecutor(max_workers=1)
+        self.queue = deque()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.max_batch = max_batch
+        self.wakeup = None
+        self.task = None
+        self.hits = 0
+        self.batches = 0
+        
+    def _load(self):
+        model = self.loader()
+        model.generate_batch(['warm up'],maxlen=16)
+        return model
+        
+    def start(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+            
+    async def generate(self,seed='',temp=0.5,maxlen=100):
+        key = (seed,temp,maxlen)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+        future = asyncio.get_event_loop().create_future()
+        self.queue.append((key,future))
+        self.start()
+        self.wakeup.set()
+        return await future
+        
+    def _generate(self,seeds,temp,maxlen):
+        return self.model.generate_batch(seeds,maxlen=maxlen,temp=temp)
+        
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.model is None:
+                try:
+                    self.model = await loop.run_in_executor(self.workers,self._load)
+                except Exception as e:
+                    traceback.print_exc()
+                    while len(self.queue) > 0:
+                        key,future = self.queue.popleft()
+                        if not future.cancelled():
+                            future.set_exception(e)
+                    return
+            while len(self.queue) > 0:
+                seed,temp,maxlen = self.queue[0][0]
+                batch = [(key,future) for key,future in self.queue if key[1:] == (temp,maxlen) and not future.cancelled()]
+                batch = batch[:self.max_batch]
+                for request in batch:
+                    self.queue.remove(request)
+                while len(self.queue) > 0 and self.queue[0][1].cancelled():
+                    self.queue.popleft()
+                if len(batch) == 0:
+                    continue
+                seeds = list(OrderedDict.fromkeys(key[0] for key,future in batch))
+                try:
+                    results = await loop.run_in_executor(self.workers,self._generate,seeds,temp,maxlen)
+                except Exception as e:
+                    for key,future in batch:
+                        if not future.cancelled():
+                            future.set_exception(e)
+                    continue
+                self.batches += 1
+                results = dict(zip(seeds,results))
+                for seed in seeds:
+                    self.cache[(seed,temp,maxlen)] = results[seed]
+                    self.cache.move_to_end((seed,temp,maxlen))
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                for key,future in batch:
+                    if not future.cancelled():
+                        future.set_result(results[key[0]])
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        for key,future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        self.workers.shutdown(wait=False)
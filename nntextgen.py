@@ -1,27 +1,25 @@
 import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 
+from collections import deque
+
 from keras.layers import Input, Embedding, LSTM, Dense, Flatten, concatenate
 from keras.models import Model, load_model
-from keras.callbacks import ModelCheckpoint
+from keras.callbacks import ModelCheckpoint, LambdaCallback, Callback
 from keras.utils import np_utils
 
-c_start = 96
-c_stop = 97
-c_size = 97
-
-def c2i(c):
-    if len(c) != 1:
-        return None
-    i = ord(c)
-    return i-32+1 if i >= 32 and i <= 126 else None
+from logshards import log_shards, shard_lines
+from nnlite import c_start, c_stop, c_size, c2i, i2c, sample_state, sample_states, encode_message, encode_texts, decode_codes, decode_batch, LiteLanguageCenter
 
-def i2c(i):
-    return chr(i+32-1) if i >= 1 and i <= 95 else ''
-        
 def get_text(msg):
-    return ''.join([i2c(i-1) for i in msg])
+    return decode_codes(np.asarray(msg,dtype='int64')-1)
 
 def i2state(i):
     state = np.zeros(c_size)
@@ -31,25 +29,6 @@ def i2state(i):
 def state2i(state):
     return np.argmax(state)+1
     
-def sample_state(state,temperature=0.2):
-    state = np.asarray(state).astype('float64')
-    state = np.log(state) / temperature
-    exp_state = np.exp(state)
-    state = exp_state / np.sum(exp_state)
-    probs = np.random.multinomial(1, state, 1)
-    return i2c(np.argmax(probs)+1)
-    
-def encode_message(msg,seed=False,ngram_size=None):
-    msg = [c_start]+[c2i(c) for c in msg if c2i(c) is not None]
-    if not seed:
-        msg.append(c_stop)
-    if ngram_size is not None:
-        if len(msg)>ngram_size:
-            msg = msg[:ngram_size]
-        else:
-            msg += [0]*(ngram_size-len(msg))
-    return np.asarray(msg)
-    
 def extract_ngram(vec,i,length,val):
     if i+length <= len(vec):
         return vec[i:i+length]
@@ -66,7 +45,157 @@ def ngram_iter(text,ngram_size=None,stride=1):
     else:
         ints = encode_message(text)
         yield from (extract_ngram(ints,i,ngram_size,c_stop) for i in range(0,len(ints)+1-ngram_size,stride))
+
+def window_starts(offsets,ngram_size,stride=1):
+    lengths = np.diff(offsets)
+    counts = np.maximum(lengths-ngram_size-1,-1)//stride+1
+    first = np.cumsum(counts)-counts
+    index = np.arange(np.sum(counts))
+    return np.repeat(offsets[:-1],counts)+stride*(index-np.repeat(first,counts))
+
+def window_batches(chunks,ngram_size,stride=1,mini_batch=32):
+    span = np.arange(ngram_size+1)
+    for codes,offsets in chunks:
+        starts = window_starts(offsets,ngram_size,stride)
+        for i in range(0,len(starts),mini_batch):
+            windows = codes[starts[i:i+mini_batch,np.newaxis]+span].astype('int32')
+            yield windows[:,:-1],windows[:,-1]-1
+
+def message_chunks(gen,chunk_size=5000,position=0):
+    gen = iter(gen)
+    while True:
+        msgs = list(itertools.islice(gen,chunk_size))
+        if len(msgs) == 0:
+            return
+        position += len(msgs)
+        yield position,encode_texts(msgs)
+
+def prefix_samples(codes,offsets,min_len=5,max_len=50):
+    lengths = np.diff(offsets)
+    counts = np.maximum(np.minimum(lengths,max_len)-min_len+1,0)
+    first = np.cumsum(counts)-counts
+    index = np.arange(np.sum(counts))
+    return np.repeat(offsets[:-1],counts),index-np.repeat(first,counts)+min_len-1
+
+def bucket_batches(chunks,bounds,min_len=5,max_len=50,batch=5000,position=0):
+    # yields the position before the oldest chunk still held in a bucket, so resuming there loses no samples
+    pending = [[] for bound in bounds]
+    sizes = [0]*len(bounds)
+    oldest = [None]*len(bounds)
+    def drain(i):
+        x,y = np.concatenate([x for x,y in pending[i]]),np.concatenate([y for x,y in pending[i]])
+        pending[i],sizes[i],oldest[i] = [],0,None
+        return x,y,min([start for start in oldest if start is not None],default=position)
+    for end,(codes,offsets) in chunks:
+        starts,lengths = prefix_samples(codes,offsets,min_len,max_len)
+        buckets = np.searchsorted(bounds,lengths)
+        for i,bound in enumerate(bounds):
+            selected = buckets == i
+            if not np.any(selected):
+                continue
+            start,length = starts[selected],lengths[selected]
+            span = np.arange(bound)
+            x = codes[np.minimum(start[:,np.newaxis]+span,len(codes)-1)]
+            x = np.where(span < length[:,np.newaxis],x,0).astype('int32')
+            pending[i].append((x,codes[start+length].astype('int32')-1))
+            sizes[i] += len(start)
+            if oldest[i] is None:
+                oldest[i] = position
+        position = end
+        for i in range(len(bounds)):
+            if sizes[i] >= batch:
+                yield drain(i)
+    for i in range(len(bounds)):
+        if sizes[i] > 0:
+            yield drain(i)
+
+def encode_shard(args):
+    path,start,end,strip = args
+    return encode_texts(list(shard_lines(path,start,end,strip)))
+
+def ngram_dataset(batches,ngram_size):
+    signature = (tf.TensorSpec(shape=(None,ngram_size),dtype=tf.int32),tf.TensorSpec(shape=(None,),dtype=tf.int32))
+    return tf.data.Dataset.from_generator(lambda: batches,output_signature=signature).prefetch(tf.data.AUTOTUNE)
+        
+class TrainingProgress(Callback):
+    def __init__(self,lc,source,resume=False,checkpoint_interval=600,metrics_interval=60):
+        super().__init__()
+        self.lc = lc
+        self.checkpoint_interval = checkpoint_interval
+        self.metrics_interval = metrics_interval
+        self.progress_file = lc.model_name+'.progress.json'
+        self.metrics_file = lc.model_name+'.metrics.jsonl'
+        self.state = {'source':source,'position':0,'samples':0,'tokens':0,'loss':None}
+        if resume and os.path.exists(self.progress_file):
+            with open(self.progress_file) as f:
+                state = json.load(f)
+            if state['source'] != source:
+                raise RuntimeError('%s was recorded for a different training stream'%self.progress_file)
+            self.state = state
+            print('resuming at position',self.state['position'],'after',self.state['samples'],'samples')
+        self.pulled = self.state['position']
+        self.queue = deque()
+        self.window_samples,self.window_tokens = 0,0
+        self.last_metrics = self.last_checkpoint = time.time()
+        
+    @property
+    def position(self):
+        return self.state['position']
         
+    def chunks(self,chunks,positions=False):
+        for position,chunk in chunks:
+            yield (position,chunk) if positions else chunk
+            self.pulled = position
+            
+    def batches(self,batches):
+        for x,y in batches:
+            self.queue.append((len(y),int(np.count_nonzero(x)),self.pulled))
+            yield x,y
+            
+    def on_train_batch_end(self,batch,logs=None):
+        if len(self.queue) > 0:
+            self.advance(*self.queue.popleft(),loss=(logs or {}).get('loss'))
+            
+    def advance(self,samples,tokens,position,loss=None):
+        self.state['samples'] += samples
+        self.state['tokens'] += tokens
+        self.state['position'] = position
+        if loss is not None:
+            self.state['loss'] = float(loss)
+        self.window_samples += samples
+        self.window_tokens += tokens
+        now = time.time()
+        if now-self.last_metrics >= self.metrics_interval:
+            self.write_metrics(now)
+        if now-self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+            
+    def write_metrics(self,now=None):
+        now = now or time.time()
+        elapsed = max(now-self.last_metrics,1e-9)
+        metrics = dict(time=now,position=self.state['position'],samples=self.state['samples'],tokens=self.state['tokens'],loss=self.state['loss'],
+                       samples_per_sec=self.window_samples/elapsed,tokens_per_sec=self.window_tokens/elapsed)
+        with open(self.metrics_file,'a') as f:
+            f.write(json.dumps(metrics)+'\n')
+        print('position %i: %i samples, %0.0f samples/s, %0.0f tokens/s, loss %s' % (metrics['position'],metrics['samples'],metrics['samples_per_sec'],metrics['tokens_per_sec'],metrics['loss']))
+        self.window_samples,self.window_tokens = 0,0
+        self.last_metrics = now
+        
+    def checkpoint(self):
+        root,ext = os.path.splitext(self.lc.model_name)
+        self.lc.model.save(root+'.tmp'+ext)
+        os.replace(root+'.tmp'+ext,self.lc.model_name)
+        with open(self.progress_file+'.tmp','w') as f:
+            json.dump(self.state,f)
+        os.replace(self.progress_file+'.tmp',self.progress_file)
+        self.last_checkpoint = time.time()
+        
+    def finish(self,completed):
+        if completed:
+            self.state['position'] = self.pulled
+        self.write_metrics()
+        self.checkpoint()
+
 class LanguageCenter:
     def __init__(self,vocab_size=c_size,embedding_space=100,lstm_space=500,lstm_depth=4,dense_size=500,dense_depth=2,model='neural.h5'):
         self.model_name = model
@@ -81,7 +210,7 @@ class LanguageCenter:
             return
             
         ngram_input = Input(shape=(None,), name='ngram_input')
-        embedding = Embedding(output_dim=embedding_space,input_dim=vocab_size+1,input_length=None)(ngram_input)
+        embedding = Embedding(output_dim=embedding_space,input_dim=vocab_size+1,input_length=None,mask_zero=True)(ngram_input)
         prev_layer = embedding
         lstm_layers = []
         assert lstm_depth > 0, 'need at least one LSTM layer'
@@ -99,12 +228,14 @@ class LanguageCenter:
             dense_layers.append(prev_layer)
         output = Dense(vocab_size, name='letter_out', activation='softmax')(prev_layer)
         self.model = Model(inputs=[ngram_input], outputs=[output])
-        self.model.compile(loss='categorical_crossentropy', optimizer='adam')
+        self.model.compile(loss='sparse_categorical_crossentropy', optimizer='adam')
         
     def __getstate__(self):
         state = self.__dict__.copy()
         del state['model']
         del state['graph']
+        del state['decoder']
+        del state['decoder_lstms']
         self.model.save(self.model_name)
         return state
         
@@ -115,72 +246,193 @@ class LanguageCenter:
         
     def _thread_init(self):
         self.graph = tf.compat.v1.get_default_graph()   
+        self.decoder = None
+        self.decoder_lstms = []
+        
+    def _embedding(self):
+        return [layer for layer in self.model.layers if isinstance(layer,Embedding)][0]
+        
+    def _build_decoder(self):
+        embedding = self._embedding()
+        char_input = Input(shape=(1,), name='char_input')
+        prev_layer = embedding(char_input)
+        state_inputs, state_outputs = [], []
+        i = 0
+        while 'lstm_%i'%i in [layer.name for layer in self.model.layers]:
+            lstm = self.model.get_layer('lstm_%i'%i)
+            config = lstm.get_config()
+            config.update(name='lstm_step_%i'%i, return_sequences=True, return_state=True)
+            step = LSTM.from_config(config)
+            h_input = Input(shape=(lstm.units,), name='h_input_%i'%i)
+            c_input = Input(shape=(lstm.units,), name='c_input_%i'%i)
+            prev_layer,state_h,state_c = step(prev_layer, initial_state=[h_input,c_input])
+            self.decoder_lstms.append((step,lstm))
+            state_inputs += [h_input,c_input]
+            state_outputs += [state_h,state_c]
+            i += 1
+        prev_layer = self.model.get_layer('state_history')([state_h,state_h,state_c])
+        i = 0
+        while 'dense_%i'%i in [layer.name for layer in self.model.layers]:
+            prev_layer = self.model.get_layer('dense_%i'%i)(prev_layer)
+            i += 1
+        output = self.model.get_layer('letter_out')(prev_layer)
+        self.decoder = Model(inputs=[char_input]+state_inputs, outputs=[output]+state_outputs)
+        
+    def decode_step(self,chars,states):
+        outputs = self.decoder.predict_on_batch([np.asarray(chars).reshape(-1,1)]+states)
+        return outputs[0],outputs[1:]
 
-    def train_from_gen(self,gen,stride=1,batch=5000,mini_batch=32,test_seed=None,ngram_size=50,skip=0):
+    def train_from_gen(self,gen,stride=1,batch=5000,mini_batch=32,test_seed=None,ngram_size=50,skip=0,resume=False,checkpoint_interval=600,stream=None):
         if test_seed is not None:
             print(self.generate(test_seed))
-        if ngram_size > 0:
-            x,y = [],[]
-            skipping = skip!=0 if skip is not None else False
-            for imsg,msg in enumerate(gen):
-                for ngram in ngram_iter(msg,ngram_size+1,stride):
-                    if len(ngram) != ngram_size+1:
-                        continue
-                    x.append(ngram[:-1])
-                    y.append(i2state(ngram[-1]))
-                    if len(x) == batch:
-                        if imsg > skip:
-                            skipping = False
-                        if not skipping:
-                            self.model.fit(x,y,batch_size=mini_batch)
-                        x,y = [],[]
-                        if not skipping and test_seed is not None:
-                            print(self.generate(test_seed))
-        else:
-            max_ngram_size = -ngram_size
-            depth = []
-            for i in range(max_ngram_size):
-                depth.append(([],[]))
-            skipping = skip!=0 if skip is not None else False
-            for imsg,msg in enumerate(gen):
-                for ngram in ngram_iter(msg,ngram_size,stride):
-                    if len(ngram) < 5 or len(ngram) > max_ngram_size:
-                        continue
-                    x,y = depth[len(ngram)-1]
-                    x.append(ngram[:-1])
-                    y.append(i2state(ngram[-1]))
-                    if len(x) == batch:
-                        if imsg > skip:
-                            skipping = False
-                        if not skipping:
-                            print('running ngram length',len(ngram))
-                            x,y = np.asarray(x),np.asarray(y)
-                            self.model.fit(x,y,batch_size=mini_batch)
-                        depth[len(ngram)-1] = ([],[])
-                        if not skipping and len(ngram) > 10 and test_seed is not None:
-                            self.generate(test_seed,verbose=True)
-                if imsg%1000 == 0 and imsg>0:
-                    print('processed',imsg,'messages')
+        self._compile_sparse()
+        # stream names the message source (e.g. a file path) so resume refuses a checkpoint taken on another one
+        progress = TrainingProgress(self,{'stream':stream,'ngram_size':ngram_size,'stride':stride},resume=resume,checkpoint_interval=checkpoint_interval)
+        skip = progress.position or skip
+        gen = itertools.islice(gen,skip,None) if skip else gen
+        chunks = message_chunks(gen,batch,skip)
+        completed = False
+        try:
+            if ngram_size > 0:
+                batches = window_batches(progress.chunks(chunks),ngram_size,stride,mini_batch)
+                self.fit_stream(progress.batches(batches),ngram_size,sample_every=max(batch//mini_batch,1),test_seed=test_seed,progress=progress)
+            else:
+                max_ngram_size = -ngram_size
+                bounds = self.bucket_bounds(max_ngram_size-1)
+                for x,y,position in bucket_batches(progress.chunks(chunks,positions=True),bounds,5,max_ngram_size,batch,skip):
+                    print('running bucket length',x.shape[1])
+                    history = self.model.fit(x,y,batch_size=mini_batch)
+                    progress.advance(len(y),int(np.count_nonzero(x)),position,history.history['loss'][-1])
+                    if x.shape[1] > 10 and test_seed is not None:
+                        self.generate(test_seed,verbose=True)
+            completed = True
+        finally:
+            progress.finish(completed)
+        
+    def bucket_bounds(self,max_len,buckets=(8,16,32,64,128,256)):
+        if not self._embedding().mask_zero:
+            return np.arange(4,max_len+1)
+        return np.asarray([bound for bound in buckets if bound < max_len]+[max_len])
+        
+    def _compile_sparse(self):
+        if self.model.loss != 'sparse_categorical_crossentropy':
+            self.model.compile(loss='sparse_categorical_crossentropy', optimizer=self.model.optimizer or 'adam')
+            
+    def fit_stream(self,batches,ngram_size,sample_every=150,test_seed=None,progress=None):
+        self._compile_sparse()
+        batches = iter(batches)
+        first = next(batches,None)
+        if first is None:
+            print('no samples left to train on')
+            return
+        batches = itertools.chain([first],batches)
+        callbacks = [progress] if progress is not None else []
+        if test_seed is not None:
+            callbacks.append(LambdaCallback(on_batch_end=lambda i,logs: print('\n'+self.generate(test_seed)) if (i+1)%sample_every == 0 else None))
+        self.model.fit(ngram_dataset(batches,ngram_size),callbacks=callbacks)
+        
+    def train_from_logs(self,paths,workers=None,ngram_size=50,stride=1,mini_batch=32,shard_size=16<<20,strip=None,test_seed=None,resume=False,checkpoint_interval=600):
+        shards = [shard+(strip,) for shard in log_shards(paths,shard_size)]
+        source = {'logs':list(paths),'shard_size':shard_size,'strip':strip,'ngram_size':ngram_size,'stride':stride}
+        progress = TrainingProgress(self,source,resume=resume,checkpoint_interval=checkpoint_interval)
+        completed = False
+        try:
+            with multiprocessing.Pool(workers) as pool:
+                encoded = enumerate(pool.imap(encode_shard,shards[progress.position:]),progress.position+1)
+                batches = window_batches(progress.chunks(encoded),ngram_size,stride,mini_batch)
+                self.fit_stream(progress.batches(batches),ngram_size,test_seed=test_seed,progress=progress)
+            completed = True
+        finally:
+            progress.finish(completed)
         
     def generate(self,seed='',maxlen=100,temp=0.5,verbose=False):
+        generated = self.generate_batch([seed],maxlen=maxlen,temp=temp)[0]
         if verbose:
-            print(seed,end='',flush=True)
-        generated = seed
-        seed = encode_message(seed,seed=True)
-        while len(generated) < maxlen:
-            guess = self.model.predict(seed[np.newaxis,:])
-            c = sample_state(guess[0],temperature=temp)
-            if len(c) == 0:
-                break
-            i = c2i(c)
-            seed = np.append(seed,i)
-            generated += c
-            if verbose:
-                print(i2c(i),end='',flush=True)
-        if verbose:
-            print('\n',end='',flush=True)
+            print(generated,flush=True)
         return generated
         
+    def initial_states(self,batch):
+        if self.decoder is None:
+            self._build_decoder()
+        for step,lstm in self.decoder_lstms:
+            step.set_weights(lstm.get_weights())
+        return [np.zeros((batch,int(state.shape[-1])),dtype='float32') for state in self.decoder.inputs[1:]]
         
+    def generate_batch(self,seeds,maxlen=100,temp=0.5):
+        return decode_batch(self.decode_step,self.initial_states(len(seeds)),seeds,maxlen=maxlen,temp=temp)
         
-        
+    def export(self,path):
+        weights = {}
+        weights['embedding'] = self._embedding().get_weights()[0]
+        for layer in self.model.layers:
+            if isinstance(layer,LSTM):
+                kernel,recurrent_kernel,bias = layer.get_weights()
+                weights[layer.name+'_kernel'] = kernel
+                weights[layer.name+'_recurrent_kernel'] = recurrent_kernel
+                weights[layer.name+'_bias'] = bias
+                weights[layer.name+'_activation'] = np.asarray(layer.get_config()['activation'])
+                weights[layer.name+'_recurrent_activation'] = np.asarray(layer.get_config()['recurrent_activation'])
+            elif isinstance(layer,Dense):
+                kernel,bias = layer.get_weights()
+                weights[layer.name+'_kernel'] = kernel
+                weights[layer.name+'_bias'] = bias
+                weights[layer.name+'_activation'] = np.asarray(layer.get_config()['activation'])
+        np.savez(path,**weights)
+
+def check_export(model,npz,seeds=('hello','how are you doing?','a'),tolerance=1e-4):
+    lc = LanguageCenter(model=model)
+    lite = LiteLanguageCenter(model=npz)
+    codes = [encode_message(seed) for seed in seeds]
+    steps = max(len(c) for c in codes)
+    chars = np.full((len(seeds),steps),c_stop,dtype='int32')
+    for row,c in enumerate(codes):
+        chars[row,:len(c)] = c
+    states,lite_states = lc.initial_states(len(seeds)),lite.initial_states(len(seeds))
+    worst = 0.0
+    for step in range(steps):
+        out,states = lc.decode_step(chars[:,step],states)
+        lite_out,lite_states = lite.decode_step(chars[:,step],lite_states)
+        worst = max([worst,float(np.max(np.abs(out-lite_out)))]+[float(np.max(np.abs(a-b))) for a,b in zip(states,lite_states)])
+    print('%i seeds, %i steps, largest difference %g (tolerance %g)' % (len(seeds),steps,worst,tolerance))
+    return worst <= tolerance
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Neural network text generator tools')
+    sub = parser.add_subparsers(dest='command')
+    export = sub.add_parser('export', help='write the weights of a trained model to a .npz for nnlite')
+    export.add_argument('model', help='trained keras model, e.g. nn.h5')
+    export.add_argument('dst', help='output .npz, e.g. nn.npz')
+    check = sub.add_parser('check-export', help='compare the decoder outputs of a keras model and its nnlite export')
+    check.add_argument('model', help='trained keras model, e.g. nn.h5')
+    check.add_argument('npz', help='exported weights, e.g. nn.npz')
+    check.add_argument('--tolerance', type=float, default=1e-4)
+    train = sub.add_parser('train', help='train a model (created if missing) on log files, encoded by a process pool')
+    train.add_argument('model', help='keras model to train and save, e.g. nn.h5')
+    train.add_argument('logs', nargs='+')
+    train.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    train.add_argument('--ngram-size', type=int, default=50)
+    train.add_argument('--stride', type=int, default=1)
+    train.add_argument('--mini-batch', type=int, default=32)
+    train.add_argument('--shard-size', type=int, default=16, help='shard size in MB')
+    train.add_argument('--strip', default=None, help='regex removed from each line, e.g. timestamps')
+    train.add_argument('--test-seed', default=None, help='print a sample from this seed while training')
+    train.add_argument('--resume', action='store_true', help='continue after the last checkpointed shard')
+    train.add_argument('--checkpoint-interval', type=int, default=600, help='seconds between checkpoints')
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        LanguageCenter(model=args.model).export(args.dst)
+        print('exported',args.model,'to',args.dst)
+    elif args.command == 'check-export':
+        return 0 if check_export(args.model,args.npz,tolerance=args.tolerance) else 1
+    elif args.command == 'train':
+        lc = LanguageCenter(model=args.model)
+        lc.train_from_logs(args.logs,workers=args.workers,ngram_size=args.ngram_size,stride=args.stride,mini_batch=args.mini_batch,
+                           shard_size=args.shard_size<<20,strip=args.strip,test_seed=args.test_seed,
+                           resume=args.resume,checkpoint_interval=args.checkpoint_interval)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,7 @@ import string
 import urllib.parse
 import urllib.request
 import markov
+import nnlite
 import random
 import traceback
 import time
@@ -14,39 +15,102 @@ import asyncio
 
 from aiohttp import ClientSession
 from concurrent.futures import ThreadPoolExecutor
-from collections import deque
+from collections import deque, OrderedDict
+
+tag_escapes = {':':';','s':' ','\\':'\\','r':'\r','n':'\n'}
+tag_escape_re = re.compile(r'\\(.?)')
+
+def unescape_tag(value):
+    return tag_escape_re.sub(lambda m: tag_escapes.get(m.group(1),m.group(1)),value)
+
+def irc_command(message):
+    start = 0
+    if message[0] == '@':
+        start = message.find(' ')+1
+    if message[start:start+1] == ':':
+        start = message.find(' ',start)+1
+    end = message.find(' ',start)
+    return (message[start:] if end == -1 else message[start:end]).upper()
 
 class IRCMessage:
+    __slots__ = ('raw','_cmd','_prefix','_args','_tags')
 
     def __init__(self,message):
-        self.raw = message
-        print('>>',message.strip())
         if len(message) < 1:
            raise RuntimeError('empty message')
+        self.raw = message
+        self._cmd = None
+        self._args = None
+
+    def _parse(self):
+        message = self.raw
+        self._tags = {}
+        if message[0] == '@':
+            tags, message = message[1:].split(' ', 1)
+            for tag in tags.split(';'):
+                key,_,value = tag.partition('=')
+                self._tags[key] = unescape_tag(value)
         if message[0] == ':':
-            self.prefix, message = message[1:].split(' ', 1)
+            self._prefix, message = message[1:].split(' ', 1)
         else:
-            self.prefix = None
+            self._prefix = None
         if message.find(' :') != -1:
             message, rest = message.split(' :', 1)
-            self.args = message.split(' ')
-            self.args.append(rest)
+            args = message.split(' ')
+            args.append(rest)
         else:
-            self.args = message.split()
-        self.cmd = self.args.pop(0).upper()
+            args = message.split()
+        self._cmd = args.pop(0).upper()
+        self._args = args
+
+    @property
+    def cmd(self):
+        if self._cmd is None:
+            self._cmd = irc_command(self.raw)
+        return self._cmd
+
+    @property
+    def prefix(self):
+        if self._args is None:
+            self._parse()
+        return self._prefix
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._parse()
+        return self._args
+
+    @property
+    def tags(self):
+        if self._args is None:
+            self._parse()
+        return self._tags
 
     def __str__(self):
         return self.raw
 
 class IRCConnection:
 
-    def __init__(self,filter_re_map={}):
-        self.buff = ''
+    def __init__(self,filter_re_map={},burst=5,rate=0.5,max_queue=500):
+        self.buff = bytearray()
         self.pending = deque()
         self.last = {}
-        self.throttle = {}
         self.filter_re_map = filter_re_map
         self.reader, self.writer = None,None
+        self.burst = burst
+        self.rate = rate
+        self.max_queue = max_queue
+        self.tokens = burst
+        self.refilled = time.time()
+        self.priority = deque()
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.peak = 0
+        self.sent = 0
+        self.dropped = 0
+        self.wakeup = None
+        self.sender = None
         
     async def connect(self,host,port,use_ssl=True,loop=None):
         if use_ssl:
@@ -54,6 +118,18 @@ class IRCConnection:
         else:
             self.sc = None
         self.reader, self.writer = await asyncio.open_connection(host, port, ssl=self.sc)
+        self.wakeup = asyncio.Event()
+        self.sender = asyncio.ensure_future(self.run_sender())
+        
+    def close(self):
+        if self.sender is not None:
+            self.sender.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            
+    def stats(self):
+        return {'queued':self.queued,'peak':self.peak,'sent':self.sent,'dropped':self.dropped,'tokens':self.tokens,
+                'priority':len(self.priority),'targets':{target:len(queue) for target,queue in self.queues.items()}}
     
     async def send(self,cmd,*args,rest=None):
         cmd = cmd.upper()
@@ -67,15 +143,6 @@ class IRCConnection:
                 return
             else:
                 self.last[dest] = rest
-            if dest in self.throttle:
-                throttle = self.throttle[dest]
-                if len(throttle) == 5 and time.time() - throttle[4] <= 5:
-                    print('TT',cmd,args,rest)
-                    return
-                else:
-                    throttle.appendleft(time.time())
-            else:
-                self.throttle[dest] = deque(maxlen=5)
         if len(args) > 0:
             packet = '%s %s' % (cmd,' '.join(args))
         else:
@@ -86,21 +153,161 @@ class IRCConnection:
             packet = '%s' % (packet)
         if len(packet) > 510:
             packet = packet[:510]
-        print('<<',packet)
-        packet = packet + '\r\n'
-        self.writer.write(packet.encode('UTF-8'))
-        await self.writer.drain()
+        if cmd == 'PONG':
+            self.priority.append(packet)
+        else:
+            target = args[0].upper() if (cmd == 'PRIVMSG' or cmd == 'NOTICE') else ''
+            queue = self.queues.setdefault(target,deque())
+            if len(queue) >= self.max_queue:
+                print('QQ',queue.popleft())
+                self.dropped += 1
+                self.queued -= 1
+            queue.append(packet)
+        self.queued += 1
+        self.peak = max(self.peak,self.queued)
+        self.wakeup.set()
+        
+    def _take_packets(self):
+        now = time.time()
+        self.tokens = min(self.burst,self.tokens+(now-self.refilled)*self.rate)
+        self.refilled = now
+        packets = list(self.priority)
+        self.priority.clear()
+        self.tokens -= len(packets)
+        while self.tokens >= 1 and len(self.queues) > 0:
+            target,queue = next(iter(self.queues.items()))
+            packets.append(queue.popleft())
+            self.tokens -= 1
+            if len(queue) > 0:
+                self.queues.move_to_end(target)
+            else:
+                del self.queues[target]
+        self.queued -= len(packets)
+        return packets
+        
+    async def run_sender(self):
+        while True:
+            if self.queued == 0:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            packets = self._take_packets()
+            if len(packets) > 0:
+                for packet in packets:
+                    print('<<',packet)
+                self.writer.write(''.join(packet+'\r\n' for packet in packets).encode('UTF-8'))
+                self.sent += len(packets)
+                await self.writer.drain()
+            if self.queued > 0 and len(self.priority) == 0 and self.tokens < 1:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(),(1-self.tokens)/self.rate)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+        
+    async def recv_line(self):
+        while len(self.pending) == 0:
+            data = await self.reader.read(65536)
+            if len(data) == 0:
+                raise ConnectionResetError('connection closed')
+            end = data.rfind(b'\n')
+            if end == -1:
+                self.buff += data
+                continue
+            self.buff += data[:end]
+            lines = self.buff.decode('UTF-8',errors='ignore').split('\n')
+            self.buff = bytearray(data[end+1:])
+            self.pending.extend(line for line in (line.rstrip('\r') for line in lines) if line)
+        return self.pending.popleft()
         
     async def recv(self):
-        if len(self.pending) > 0:
-            return IRCMessage(self.pending.popleft())
-        data = await self.reader.read(1024)
-        self.buff = self.buff + data.decode('UTF-8',errors='ignore')
-        parts = self.buff.split('\r\n')
-        self.buff = parts.pop() 
-        self.pending.extend(parts)
-        return IRCMessage(self.pending.popleft())
+        return IRCMessage(await self.recv_line())
+        
+    def __aiter__(self):
+        return self
+        
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionResetError:
+            raise StopAsyncIteration
+        
+class Dispatcher:
+
+    def __init__(self,max_tasks=16,max_queue=100,overload=64,max_pending=1000):
+        self.max_queue = max_queue
+        self.max_pending = max_pending
+        self.overload = overload
+        self.semaphore = asyncio.Semaphore(max_tasks)
+        self.queues = {}
+        self.tasks = {}
+        self.pending = 0
+        self.shed = 0
+        self.latency = {}
+        
+    def overloaded(self):
+        return self.pending >= self.overload
+        
+    def submit(self,key,name,func,*args,priority=False):
+        # checked before a queue or task is created, so many senders can't grow them without bound
+        queue = self.queues.get(key)
+        if (queue is not None and len(queue) >= self.max_queue) or (self.pending >= self.max_pending and not priority):
+            self.shed += 1
+            print('SS',name,key)
+            return False
+        if queue is None:
+            queue = self.queues[key] = deque()
+        queue.append((name,func,args,priority,time.time()))
+        self.pending += 1
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.ensure_future(self.run_queue(key))
+        return True
+        
+    async def _run(self,name,func,args,queued):
+        started = time.time()
+        try:
+            await func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+        finally:
+            finished = time.time()
+            count,wait,run,peak = self.latency.get(name,(0,0.0,0.0,0.0))
+            self.latency[name] = (count+1,wait+started-queued,run+finished-started,max(peak,finished-started))
         
+    async def run_queue(self,key):
+        queue = self.queues[key]
+        try:
+            while len(queue) > 0:
+                name,func,args,priority,queued = queue.popleft()
+                try:
+                    if priority:
+                        await self._run(name,func,args,queued)
+                    else:
+                        async with self.semaphore:
+                            await self._run(name,func,args,queued)
+                finally:
+                    self.pending -= 1
+        finally:
+            if self.tasks.get(key) is asyncio.current_task():
+                del self.tasks[key]
+            if len(queue) == 0 and self.queues.get(key) is queue:
+                del self.queues[key]
+            
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        for queue in self.queues.values():
+            self.pending -= len(queue)
+            queue.clear()
+        self.queues.clear()
+        
+    def stats(self):
+        handlers = {name:{'count':count,'wait':wait/count,'run':run/count,'max':peak} for name,(count,wait,run,peak) in self.latency.items()}
+        return {'pending':self.pending,'queues':len(self.queues),'shed':self.shed,'handlers':handlers}
+
 def strip_prefix(prefix):
     if prefix.find('!') != -1:
         nick,*_ = prefix.split('!')
@@ -124,17 +331,11 @@ class IRCChannel:
         
         self.mc = None
         self.mc_learning = False
-        self.mc_lock = asyncio.Lock()
         self.reply_prob = 0.01
         
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['mc_lock']
-        return state
-        
     def __setstate__(self,state):
         self.__dict__.update(state)
-        self.mc_lock = asyncio.Lock()
+        self.mc = markov.rejoin_chain(self.mc)
         
     def badword_tuple(self,word,style=''):
         word = word.lower()
@@ -203,6 +404,8 @@ class IRCBot:
         del state['workers']
         if 'nn' in state:
             del state['nn']
+        if 'dispatcher' in state:
+            del state['dispatcher']
         return state
         
     def __setstate__(self,state):
@@ -269,25 +472,55 @@ class IRCBot:
         if loop is None:
             loop = asyncio.get_event_loop()
         self.clean_exit = False
-        self.workers = ThreadPoolExecutor(max_workers=4)
+        if not 'workers' in self.__dict__ or self.workers is None:
+            self.workers = ThreadPoolExecutor(max_workers=4)
+        if nnlite.model_available():
+            self._nn_service()
         conn = IRCConnection()
         await conn.connect(host,port)
+        self.dispatcher = Dispatcher()
         self.update_badwords(conn)
         await conn.send('NICK',self.nick)
         await conn.send('USER',self.ident,host,'*',rest=self.realname)
         try:
             while True:
                 try:
-                    msg = await asyncio.wait_for(conn.recv(), timeout=timeout)
+                    line = await asyncio.wait_for(conn.recv_line(), timeout=timeout)
                 except asyncio.TimeoutError:
                     return False
-                if msg.cmd in self.handlers:
-                    loop.create_task(self.handlers[msg.cmd](conn,msg))
-                if msg.cmd == 'ERROR':
+                cmd = irc_command(line)
+                if cmd in self.handlers:
+                    print('>>',line)
+                    msg = IRCMessage(line)
+                    msg._cmd = cmd
+                    self.dispatcher.submit(self.dispatch_key(msg),cmd,self.handlers[cmd],conn,msg,priority=(cmd == 'PING'))
+                elif cmd == 'ERROR':
+                    print('>>',line)
+                if cmd == 'ERROR':
                     return self.clean_exit
         except:
             traceback.print_exc()
             return False
+        finally:
+            self.dispatcher.cancel()
+            conn.close()
+            
+    def dispatch_key(self,msg):
+        if msg.cmd == 'PRIVMSG':
+            # runs in the connect loop, so a malformed line must not raise here
+            dest = msg.args[0] if len(msg.args) > 0 else ''
+            if dest != '' and dest[0] in IRCBot.chan_prefix_chars:
+                return dest.upper()
+            return strip_prefix(msg.prefix or '').upper() or msg.cmd
+        if msg.cmd in ('JOIN','PART','KICK') and len(msg.args) > 0:
+            return msg.args[0].upper()
+        return msg.cmd
+        
+    def _nn_service(self):
+        if not 'nn' in self.__dict__ or self.nn is None:
+            self.nn = nnlite.NeuralService()
+        self.nn.start()
+        return self.nn
         
     async def _work_on(self,func,*args):
         return await asyncio.get_event_loop().run_in_executor(self.workers,func,*args)
@@ -419,13 +652,18 @@ class IRCBot:
             chan.mc_learning = False
             await c.send('PRIVMSG',replyto,rest='Chatting deactivated')
         elif params == 'learn':
-            chan.mc = markov.MarkovChain()
+            chan.mc = markov.open_chain()
             chan.mc_learning = True
             await c.send('PRIVMSG',replyto,rest='Now chatting and learning')
         else:
+            frozen = '%s.markov' % params.lower()
             path = '%s.sqlite' % params.lower()
-            if os.path.exists(path):
-                chan.mc = markov.MarkovChain(path)
+            if os.path.exists(frozen):
+                chan.mc = markov.open_chain(frozen)
+                chan.mc_learning = False
+                await c.send('PRIVMSG',replyto,rest='Now chatting like %s' % params)
+            elif os.path.exists(path):
+                chan.mc = markov.open_chain(path)
                 chan.mc_learning = False
                 await c.send('PRIVMSG',replyto,rest='Now chatting like %s' % params)
     
@@ -489,21 +727,9 @@ class IRCBot:
             await c.send('PRIVMSG',replyto,rest='%s %s'%(meta['data'][0]['images']['original']['url'], meta['data'][0]['title'].replace(' GIF','')))
     
     async def cmd_nn(self,c,msg,replyto,params):
-        if not 'nn' in self.__dict__ or self.nn is None:
-            try:
-                def _load_nn():                
-                    import nntextgen
-                    self.nn = nntextgen.LanguageCenter(model='nn.h5')
-                await self._work_on(_load_nn)
-            except:
-                print('can\'t load nntextgen module')
-                self.nn = None
-                raise 
         chan = self.get_chan(replyto)
-        if not chan.get_mute('neural') and self.nn:
-            def _generate():
-                return self.nn.generate(params if params else '',temp=self.nn_temp,maxlen=250)
-            text = await self._work_on(_generate)
+        if not chan.get_mute('neural'):
+            text = await self._nn_service().generate(params if params else '',temp=self.nn_temp,maxlen=250)
             await c.send('PRIVMSG',replyto,rest=text)
     
     ### Text hooks
@@ -579,14 +805,17 @@ class IRCBot:
         chan = self.get_chan(replyto)
         if chan.mc is None:
             return
+        service = markov.open_service(chan.mc)
         if chan.mc_learning:
-            async with chan.mc_lock:
-                await self._work_on(chan.mc.process,text)
+            await service.learn(text)
         if not chan.get_mute('markov'):
             if random.random() < chan.reply_prob or self.nick.upper() in text.upper():
-                seed_text = re.sub(self.nick+'[;,: ]*|[<>\\/\|\?.,\(\)!@#\$\%^&\*]','',text,flags=re.IGNORECASE)
+                if 'dispatcher' in self.__dict__ and self.dispatcher.overloaded():
+                    print('skipping markov reply in',replyto,'while overloaded')
+                    return
+                seed_text = markov.seed_remover(self.nick).sub('',text)
                 ' '.join(set(seed_text.split()))
-                reply = await self._work_on(chan.mc.gen_reply,seed_text)
+                reply = await service.reply(seed_text)
                 if reply:
                     await c.send('PRIVMSG',replyto,rest=reply)
 
@@ -686,3 +915,50 @@ class IRCBot:
             for chan in join_chans:
                 await c.send('JOIN',chan)
         
+
+class IRCSupervisor:
+
+    def __init__(self,max_workers=4,min_backoff=5.0,max_backoff=600.0):
+        self.workers = ThreadPoolExecutor(max_workers=max_workers)
+        self.nn = nnlite.NeuralService()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.networks = {}
+        self.tasks = {}
+        
+    def add_network(self,name,bot,host,port,**kwargs):
+        bot.workers = self.workers
+        bot.nn = self.nn
+        self.networks[name] = (bot,host,port,kwargs)
+        
+    async def run_network(self,name):
+        bot,host,port,kwargs = self.networks[name]
+        failures = 0
+        while True:
+            started = time.time()
+            try:
+                if await bot.connect(host,port,**kwargs):
+                    print('left',name)
+                    return
+            except Exception:
+                traceback.print_exc()
+            if time.time()-started > self.max_backoff:
+                failures = 0
+            delay = min(self.max_backoff,self.min_backoff*2**failures)
+            delay = random.uniform(delay/2,delay)
+            failures += 1
+            print('reconnecting to %s in %0.1f s'%(name,delay))
+            await asyncio.sleep(delay)
+            
+    async def run(self):
+        self.tasks = {name:asyncio.ensure_future(self.run_network(name)) for name in self.networks}
+        try:
+            await asyncio.gather(*self.tasks.values())
+        finally:
+            self.close()
+            
+    def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.nn.close()
+        self.workers.shutdown(wait=False)